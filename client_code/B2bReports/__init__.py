@@ -47,10 +47,10 @@ class B2bReports(B2bReportsTemplate):
         
     print("Fetching fresh data")
     all_data = {}
-    metrics = ['Email', 'Flyers', 'Business Cards']
     
-    for metric in metrics:
-        data = anvil.server.call('get_b2b_stats', start_date, end_date, metric)
+    # One round-trip returns every metric
+    summary = anvil.server.call('get_b2b_summary', start_date, end_date) or {}
+    for metric, data in summary.items():
         if data and "users" in data and "metrics" in data:
             all_data[metric] = data
             
@@ -6,7 +6,6 @@ import anvil.server
 import anvil.users
 import anvil.tables as tables
 import anvil.tables.query as q
-from anvil.tables import app_tables
 from datetime import datetime, timedelta, date
 
 
@@ -67,18 +66,6 @@ class EmailReports(EmailReportsTemplate):
             alert("Failed to refresh email data")
             print(f"Error: {e}")
 
-    def _get_display_name(self, email):
-        """Get user's display name from users table, fallback to email if not found"""
-        try:
-            user = app_tables.users.get(email=email)
-            if user is None:
-                return email
-            # Access the name directly from the row object
-            return user['name'] if user['name'] else email
-        except Exception as e:
-            print(f"Error getting display name for {email}: {e}")
-            return email
-
     def _update_email_plot(self, data):
         """Update the email statistics plot with a vertical bar chart."""
         try:
@@ -94,10 +81,11 @@ class EmailReports(EmailReportsTemplate):
             metric = self.email_metric_selector.selected_value or 'total'
             metric_display_name = self.metric_display_names[metric]
 
-            # Create a trace for each user with proper display name
+            # Create a trace for each user with the display name resolved on the server
+            display_names = data.get("display_names", {})
             traces = []
             for email in users:
-                display_name = self._get_display_name(email)
+                display_name = display_names.get(email, email)
                 value = data["metrics"][metric].get(email, 0)  # Get value before modifying email
                 traces.append({
                     "type": "bar",
@@ -11,6 +11,8 @@ from ..ReportsInnerFrame import ReportsInnerFrame
 
 anvil.users.login_with_form()
 
+REFRESH_POLL_INTERVAL = 1  # seconds between background refresh status checks
+
 class Frame(FrameTemplate):
     def __init__(self, **properties):
         self.init_components(**properties)
@@ -26,6 +28,11 @@ class Frame(FrameTemplate):
             )
             self.refresh_button.set_event_handler("click", self.refresh_button_click)
             self.add_component(self.refresh_button, slot="top-right")
+            
+            # Polls the background refresh job while one is running
+            self.refresh_timer = Timer(interval=0)
+            self.refresh_timer.set_event_handler("tick", self.refresh_timer_tick)
+            self.add_component(self.refresh_timer, slot="top-right")
 
             Plot.templates.default = "rally"
             
@@ -36,6 +43,9 @@ class Frame(FrameTemplate):
                 
             self._setup_navigation()
             
+            with anvil.server.no_loading_indicator:
+                self._show_last_refreshed(anvil.server.call('get_last_refreshed'))
+            
         except Exception as e:
             print(f"Error initializing Frame: {e}")
             alert(f"Error initializing Frame: {e}")
@@ -89,36 +99,39 @@ class Frame(FrameTemplate):
             active_link.foreground = 'white'
 
     def refresh_button_click(self, **event_args):
-        """Handle refresh button click - triggers database refresh APIs."""
+        """Handle refresh button click - starts the background data refresh."""
         try:
-            # Show loading indicator to user
-            notification = Notification("Refreshing data...", timeout=None)
-            notification.show()
+            # Joins a refresh already in progress (or just finished) if there is one
+            self.refresh_run_id = anvil.server.call('launch_data_refresh')
+            self.refresh_button.enabled = False
+            self.refresh_notification = Notification("Refreshing data...", timeout=None)
+            self.refresh_notification.show()
             
-            # Call APIs sequentially and capture results
-            call_reports_refreshed = anvil.server.call('fetch_call_reports')
+            # Poll the run's per-stage progress without blocking the page
+            self.refresh_timer.interval = REFRESH_POLL_INTERVAL
             
-            try:
-                email_stats = anvil.server.call('fetch_user_email_stats')
-                email_stats_status = 'Updated' if email_stats and isinstance(email_stats, list) else 'No new data'
-            except Exception as email_error:
-                print(f"Error in fetch_user_email_stats: {email_error}")
-                email_stats_status = 'Failed to update'
-            
-            # Force recalculation of averages
-            averages_recalculated = anvil.server.call('recalculate_todays_averages')
-            
-            # Log results
-            print("Refresh results:")
-            print(f"- Call reports: {'Updated' if call_reports_refreshed else 'No new data'}")
-            print(f"- Email stats: {email_stats_status}")
-            print(f"- Averages: {'Recalculated' if averages_recalculated else 'Failed to recalculate'}")
+        except Exception as e:
+            print(f"Error during data refresh: {e}")
+            alert("Failed to refresh data. Please try again.")
+
+    def refresh_timer_tick(self, **event_args):
+        """Check on the background refresh and finish up once it completes."""
+        try:
+            with anvil.server.no_loading_indicator:
+                run = anvil.server.call('get_data_refresh_status', self.refresh_run_id)
             
-            # Hide loading indicator
-            notification.hide()
+            stages = run['stages']
+            progress = ", ".join(f"{stage}: {status}" for stage, status in stages.items())
+            print(f"Refresh progress: {progress}")
+            if run['status'] == 'running':
+                return
             
-            # Show completion notification
-            Notification("Data refresh complete.", timeout=3).show()
+            self._finish_refresh()
+            self._show_last_refreshed(run['last_refreshed'])
+            if run['status'] != 'done':
+                Notification(f"Data refresh finished with errors ({progress}).", timeout=5).show()
+            else:
+                Notification("Data refresh complete.", timeout=3).show()
             
             # Refresh current page if it's the Sales page
             if self.current_page == 'sales':
@@ -127,9 +140,23 @@ class Frame(FrameTemplate):
                     current_content.refresh_data()
             
         except Exception as e:
+            self._finish_refresh()
             print(f"Error during data refresh: {e}")
             alert("Failed to refresh data. Please try again.")
 
+    def _show_last_refreshed(self, last_refreshed):
+        """Show when data was last refreshed on the refresh button's tooltip"""
+        if last_refreshed:
+            self.refresh_button.tooltip = f"Last refreshed {last_refreshed.strftime('%Y-%m-%d %H:%M')}"
+
+    def _finish_refresh(self):
+        """Stop polling and restore the refresh button"""
+        self.refresh_timer.interval = 0
+        self.refresh_button.enabled = True
+        if getattr(self, 'refresh_notification', None):
+            self.refresh_notification.hide()
+            self.refresh_notification = None
+
     def sales_page_link_click(self, **event_args):
         """Handle sales page navigation"""
         self._switch_page('sales', Sales())
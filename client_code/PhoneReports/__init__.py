@@ -9,10 +9,22 @@ import anvil.tables.query as q
 from anvil.tables import app_tables
 from datetime import datetime, timedelta, date
 
+# Call metrics shown in the chart selector and the summary grid
+CALL_METRICS = [
+    "inboundVolume", "inboundDuration", "outboundVolume", "outboundDuration",
+    "averageDuration", "volume", "totalDuration", "inboundQueueVolume"
+]
+# Ranges up to this many days are plotted per day (longer ones by week or month
+# on the server, see Rollups.pick_tier) and can be served from the day cache
+DAILY_RANGE_DAYS = 31
+
 class PhoneReports(PhoneReportsTemplate):
     def __init__(self, **properties):
         self.init_components(**properties)
         
+        # Per-day call data already fetched: date -> [(userId, userName, {metric: value})]
+        self._day_cache = {}
+        
         # Set table role and styling
         if hasattr(self, 'repeating_panel_1'):
             self.repeating_panel_1.role = 'table'
@@ -42,44 +54,73 @@ class PhoneReports(PhoneReportsTemplate):
 
     def column_selector_change(self, **event_args):
         if self.data_column_selector.selected_value:
+            # Totals don't depend on the selected metric, so only the plot changes
             self._update_plot(self.data_column_selector.selected_value)
-            self._update_repeating_panel()
 
     def refresh_data(self):
         """Fetch and display call data based on current date range."""
         try:
-            with anvil.server.no_loading_indicator:
-                data = anvil.server.call('get_call_data', 
-                                       self.start_date_picker.date, 
-                                       self.end_date_picker.date)
+            start_date = self.start_date_picker.date
+            end_date = self.end_date_picker.date
+            if (end_date - start_date).days < DAILY_RANGE_DAYS:
+                data = self._get_daily_traces(start_date, end_date)
+            else:
+                with anvil.server.no_loading_indicator:
+                    data = anvil.server.call('get_call_traces', start_date, end_date, CALL_METRICS)
             
-            if not data or "columns" not in data or "values" not in data:
+            if not data or "users" not in data or "metrics" not in data:
                 raise ValueError("Invalid data structure received")
 
-            self.column_names = data["columns"]
-            self.user_values = data["values"]
+            self.call_data = data
             self._process_data()
             
         except Exception as e:
             print(f"Error refreshing call data: {e}")
             alert(f"Error refreshing data: {e}")
 
+    def _get_daily_traces(self, start_date, end_date):
+        """Build per-user traces for a daily range, fetching only days not already cached"""
+        days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        # Today is still being ingested, so it is always fetched again
+        missing = [day for day in days if day not in self._day_cache or day >= date.today()]
+        
+        if missing:
+            with anvil.server.no_loading_indicator:
+                data = anvil.server.call('get_call_days', missing, CALL_METRICS)
+            for day in missing:
+                self._day_cache[day] = []
+            for i, report_date in enumerate(data["reportDate"]):
+                self._day_cache[report_date].append((
+                    data["userId"][i],
+                    data["userName"][i],
+                    {metric: values[i] for metric, values in data["metrics"].items()}
+                ))
+        
+        # Merge the cached days into per-user series, in date order
+        users = {}
+        for day in days:
+            for user_id, user_name, values in self._day_cache[day]:
+                user = users.get(user_id)
+                if user is None:
+                    user = users[user_id] = {
+                        'userName': user_name,
+                        'x': [],
+                        'y': {metric: [] for metric in CALL_METRICS},
+                        'totals': {metric: 0 for metric in CALL_METRICS}
+                    }
+                user['x'].append(day.strftime('%Y-%m-%d'))
+                for metric in CALL_METRICS:
+                    user['y'][metric].append(values.get(metric))
+                    if isinstance(values.get(metric), (int, float)):
+                        user['totals'][metric] += values[metric]
+        
+        return {"metrics": CALL_METRICS, "users": list(users.values())}
+
     def _process_data(self):
         """Process the fetched data and update UI components"""
         try:
-            # Process duration columns
-            duration_columns = [col for col in self.column_names if 'duration' in col.lower()]
-            for row in self.user_values:
-                for col in duration_columns:
-                    col_index = self.column_names.index(col)
-                    if row[col_index] is not None:
-                        row[col_index] = int(row[col_index] // 60000)
-
-            # Update column selector with formatted titles
-            numeric_columns = [
-                col for i, col in enumerate(self.column_names)
-                if all(isinstance(row[i], (int, float)) for row in self.user_values)
-            ]
+            # Durations arrive in minutes, so every metric column is ready to plot
+            numeric_columns = self.call_data["metrics"]
             
             if numeric_columns:
                 # Create items list with formatted display names
@@ -110,42 +151,20 @@ class PhoneReports(PhoneReportsTemplate):
             self.call_info_plot.data = []
             self.call_info_plot.layout = {}
 
-            if "reportDate" not in self.column_names or y_column not in self.column_names:
+            if y_column not in self.call_data["metrics"]:
                 raise ValueError("Required columns missing")
 
-            # Reset and set column values
-            formatted_title = None
-            y_column_value = None
-            
-            y_column_value = y_column  # Set new value
-            formatted_title = self._format_title(y_column_value)  # Set new formatted title
-
-            user_id_index = self.column_names.index('userId')
-            user_name_index = self.column_names.index('userName')
-            report_date_index = self.column_names.index('reportDate')
-            y_column_index = self.column_names.index(y_column_value)
+            formatted_title = self._format_title(y_column)
 
-            grouped_data = {}
-            user_labels = {}
-            
-            # Group data by user
-            for row in self.user_values:
-                user_id = row[user_id_index]
-                if user_id not in grouped_data:
-                    grouped_data[user_id] = {'x': [], 'y': []}
-                    user_labels[user_id] = row[user_name_index]
-                grouped_data[user_id]['x'].append(row[report_date_index].strftime('%Y-%m-%d'))
-                grouped_data[user_id]['y'].append(row[y_column_index])
-
-            # Create fresh traces
+            # Series come pre-grouped by user from the server
             traces = []
-            for user_id, data in grouped_data.items():
+            for user in self.call_data["users"]:
                 traces.append({
-                    'x': data['x'],
-                    'y': data['y'],
+                    'x': user['x'],
+                    'y': user['y'][y_column],
                     'type': 'scatter',
                     'mode': 'lines+markers',
-                    'name': user_labels[user_id]
+                    'name': user['userName']
                 })
             
             # Set complete fresh layout
@@ -176,23 +195,11 @@ class PhoneReports(PhoneReportsTemplate):
 
     def _update_repeating_panel(self):
         try:
-            selected_users = [trace['name'] for trace in self.call_info_plot.data]
-            user_name_index = self.column_names.index('userName')
-            grouped_rows = {}
-
-            # Consolidate data by user
-            for row in self.user_values:
-                user_name = row[user_name_index]
-                if user_name in selected_users:
-                    if user_name not in grouped_rows:
-                        grouped_rows[user_name] = dict(zip(self.column_names, row))
-                    else:
-                        for i, col_name in enumerate(self.column_names):
-                            if isinstance(row[i], (int, float)):
-                                grouped_rows[user_name][col_name] += row[i]
-
-            self.repeating_panel_1.items = list(grouped_rows.values())
+            # Per-user totals are computed on the server
+            self.repeating_panel_1.items = [
+                dict(user['totals'], userName=user['userName'])
+                for user in self.call_data["users"]
+            ]
 
         except Exception as e:
             print(f"Error updating repeating panel: {e}")
-
@@ -31,7 +31,7 @@ class Sales(SalesTemplate):
             start_date = self.start_date_selector.date
             end_date = self.end_date_selector.date
             
-            data = anvil.server.call('get_comparison_data', 
+            data = anvil.server.call('get_sales_dashboard', 
                                    current_user['email'],
                                    start_date,
                                    end_date)
@@ -60,6 +60,8 @@ class Sales(SalesTemplate):
             'b2b_emails_plot': ('B2B Emails', 'Count')
         }
         
+        series = data['series']
+        
         for plot_name, (title, y_label) in plots_config.items():
             metric = plot_name.replace('_plot', '')
             plot = getattr(self, plot_name)
@@ -80,6 +82,29 @@ class Sales(SalesTemplate):
                     "x": ["Current"],
                     "y": [data['average'][metric]],
                     "marker": {"color": "#ff7f0e"}
+                },
+                # Per-day sparklines under the bars
+                {
+                    "type": "scatter",
+                    "mode": "lines",
+                    "x": series['dates'],
+                    "y": series['user'][metric],
+                    "xaxis": "x2",
+                    "yaxis": "y2",
+                    "line": {"color": "#1f77b4", "width": 1},
+                    "showlegend": False,
+                    "hoverinfo": "x+y"
+                },
+                {
+                    "type": "scatter",
+                    "mode": "lines",
+                    "x": series['dates'],
+                    "y": series['average'][metric],
+                    "xaxis": "x2",
+                    "yaxis": "y2",
+                    "line": {"color": "#ff7f0e", "width": 1},
+                    "showlegend": False,
+                    "hoverinfo": "x+y"
                 }
             ]
             
@@ -87,7 +112,9 @@ class Sales(SalesTemplate):
                 "title": title,
                 "showlegend": True,
                 "xaxis": {"showticklabels": False},
-                "yaxis": {"title": y_label},
+                "yaxis": {"title": y_label, "domain": [0.3, 1]},
+                "xaxis2": {"anchor": "y2", "showticklabels": False},
+                "yaxis2": {"domain": [0, 0.2], "showticklabels": False},
                 "barmode": "group",
                 "margin": {"l": 50, "r": 50, "t": 50, "b": 30}
             }
@@ -1,10 +1,19 @@
 import anvil.secrets
 import anvil.server
-import requests
+import anvil.tables as tables
+import anvil.tables.query as q
+from . import Transport
+from . import Tokens
 import json
 import base64
 from anvil.tables import app_tables
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from ..DataAggregation.Cache import invalidate as invalidate_cache
+from ..DataAggregation.Rollups import (
+    CALL_TOTALS, apply_average_deltas, apply_rollup_deltas, column_deltas, merge_deltas,
+    row_deltas, upsert_daily_facts
+)
 
 # ===============================================
 # Configuration
@@ -27,53 +36,17 @@ def get_credentials():
 # Remove hardcoded credentials
 CLIENT_ID = None
 CLIENT_SECRET = None
-ACCESS_TOKEN = None
-REFRESH_TOKEN = None
 
 TOKEN_URL = "https://authentication.logmeininc.com/oauth/token"
 AUTH_URL = "https://authentication.logmeininc.com/oauth/authorize"
 CALL_REPORTS_URL = "https://api.goto.com/call-reports/v1/reports/user-activity"
 
-# Global variables for tokens
-ACCESS_TOKEN = None
-REFRESH_TOKEN = None
-
-# ===============================================
-# Persistent Token Storage/Loading
-# ===============================================
-def load_tokens():
-    """Load ACCESS_TOKEN and REFRESH_TOKEN from the tokens table."""
-    global ACCESS_TOKEN, REFRESH_TOKEN
-    try:
-        tokens = app_tables.tokens.search()
-        token_row = None
-        for t in tokens:
-            token_row = t
-            break
-        if token_row:
-            ACCESS_TOKEN = token_row['access_token']
-            REFRESH_TOKEN = token_row['refresh_token']
-    except Exception as e:
-        print(f"Error loading tokens: {e}")
-
-def save_tokens(access_token, refresh_token):
-    """Save ACCESS_TOKEN and REFRESH_TOKEN to the tokens table, replacing any existing rows."""
-    try:
-        for row in app_tables.tokens.search():
-            row.delete()
-        app_tables.tokens.add_row(access_token=access_token, refresh_token=refresh_token)
-    except Exception as e:
-        print(f"Error saving tokens: {e}")
-
 # ===============================================
 # Utility Functions
 # ===============================================
 def encode_client_credentials(client_id, client_secret):
     return base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
 
-# Load any previously saved tokens
-load_tokens()
-
 @anvil.server.callable
 def verify_existing_credentials():
     """Verify and set up existing credentials from the tokens table"""
@@ -98,13 +71,9 @@ def verify_existing_credentials():
             access_key = creds['Personal Access Key']
             print(f"Found Personal Access Key: {access_key[:10]}...")
             
-            # Store it as our access token
-            global ACCESS_TOKEN
-            ACCESS_TOKEN = access_key
-            
             # Test the access token
             headers = {
-                "Authorization": f"Bearer {ACCESS_TOKEN}",
+                "Authorization": f"Bearer {access_key}",
                 "Accept": "application/json"
             }
             
@@ -113,7 +82,7 @@ def verify_existing_credentials():
             test_url = f"{CALL_REPORTS_URL}?startTime={now.isoformat()}Z&endTime={now.isoformat()}Z"
             
             print("\nTesting existing credentials...")
-            response = requests.get(test_url, headers=headers)
+            response = Transport.get(test_url, headers=headers)
             
             print(f"Test API response status: {response.status_code}")
             
@@ -155,6 +124,10 @@ def get_api_keys():
 def get_and_verify_credentials():
     """Get credentials from all possible sources and verify them"""
     try:
+        # A recent successful verification is cached by the token manager
+        if Tokens.is_verified('goto'):
+            return True
+            
         print("\nAttempting to gather credentials from all sources...")
         credentials = None
         
@@ -246,7 +219,7 @@ def verify_credentials(creds):
         print(f"URL: {test_url}")
         print(f"Authorization: Bearer {personal_key[:10]}...")
         
-        response = requests.get(test_url, headers=headers)
+        response = Transport.get(test_url, headers=headers)
         
         print(f"\nAPI Response:")
         print(f"Status Code: {response.status_code}")
@@ -254,9 +227,7 @@ def verify_credentials(creds):
         if response.status_code in (200, 404):
             print("\nCredentials verified successfully!")
             
-            # Set global access token
-            global ACCESS_TOKEN
-            ACCESS_TOKEN = personal_key
+            Tokens.store_token('goto', personal_key, verified=True)
             
             try:
                 # Update tokens table with verified credentials
@@ -313,7 +284,7 @@ def test_goto_connection():
         five_mins_ago = now - timedelta(minutes=5)
         test_url = f"{CALL_REPORTS_URL}?startTime={five_mins_ago.isoformat()}Z&endTime={now.isoformat()}Z"
         
-        response = requests.get(test_url, headers=headers)
+        response = Transport.get(test_url, headers=headers)
         
         return {
             "success": response.status_code in (200, 404),
@@ -339,94 +310,286 @@ def initialize_auth():
     print("Failed to initialize using any credential source")
     return False
 
-# Remove or comment out unused OAuth-related functions
-# def refresh_access_token():
-# def handle_oauth_callback():
+# ===============================================
+# Token Management
+# ===============================================
+def _legacy_refresh_token():
+    """Refresh token saved in the tokens table before the token manager existed"""
+    try:
+        for row in app_tables.tokens.search():
+            if row['refresh_token']:
+                return row['refresh_token']
+    except Exception as e:
+        print(f"Error reading legacy refresh token: {e}")
+    return None
+
+def _obtain_token(current):
+    """Get a new GoTo token: OAuth refresh if we hold a refresh token, else re-verify the PAT"""
+    # token_cache starts empty, so the first refresh picks up the tokens table's
+    # refresh token; store_token keeps it in token_cache from then on
+    refresh_token = (current['refresh_token'] if current else None) or _legacy_refresh_token()
+    if refresh_token:
+        creds = get_credentials() or {}
+        client_secret = anvil.secrets.get_secret('client_secret') or creds.get('client_secret', '')
+        response = Transport.post(
+            TOKEN_URL,
+            headers={
+                "Authorization": f"Basic {encode_client_credentials(creds.get('client_id', ''), client_secret)}",
+                "Content-Type": "application/x-www-form-urlencoded"
+            },
+            data={"grant_type": "refresh_token", "refresh_token": refresh_token}
+        )
+        if response.status_code == 200:
+            token_data = response.json()
+            return {
+                "access_token": token_data["access_token"],
+                "expires_in": token_data.get("expires_in"),
+                "refresh_token": token_data.get("refresh_token", refresh_token)
+            }
+        print(f"Token refresh failed: {response.status_code} - {response.text}")
+
+    # Personal Access Keys don't expire on a schedule; verify and store the key
+    if not initialize_auth():
+        raise Exception("Failed to initialize authorization. Please check your credentials.")
+    entry = Tokens.get_entry('goto')
+    return {"access_token": entry['access_token'], "verified": True}
+
+def get_goto_token():
+    """Return the GoTo access token, cached across server calls by the token manager"""
+    return Tokens.get_token('goto', _obtain_token)
+
+def refresh_access_token():
+    """Replace a rejected GoTo access token with a new one"""
+    Tokens.invalidate('goto')
+    return get_goto_token()
 
 # ===============================================
 # Update Data Table with API Data
 # ===============================================
-def update_call_statistics(data):
-    today_date = datetime.utcnow().date()
+CALL_STAT_COLUMNS = [
+    "inboundVolume", "inboundDuration", "outboundVolume", "outboundDuration",
+    "averageDuration", "volume", "totalDuration", "inboundQueueVolume"
+]
 
-    for item in data.get("items", []):
-        user_id = item["userId"]
-        user_name = item["userName"]
-        data_values = item["dataValues"]
+def _fingerprint(values):
+    """Comparable fingerprint of a call_statistics row's numeric columns"""
+    return tuple(values[col] for col in CALL_STAT_COLUMNS)
 
-        # Check if a record exists for this user ID and today's date
-        existing_row = app_tables.call_statistics.get(
-            userId=user_id, reportDate=today_date
-        )
+def update_call_statistics(data, report_date=None):
+    """Upsert call statistics for report_date (default today) in bulk.
+    
+    Rows whose incoming dataValues match what is already stored are skipped,
+    and the returned counts say how many rows were added, updated or left
+    unchanged.
+    """
+    report_date = report_date or datetime.utcnow().date()
+    counts = _write_call_statistics(data, report_date)
+    if counts["added"] or counts["updated"]:
+        invalidate_cache('call_data')
+    print(f"Call statistics for {report_date}: {counts}")
+    return counts
 
-        if existing_row:
-            # Update the existing record
-            existing_row.update(
-                inboundVolume=data_values["inboundVolume"],
-                inboundDuration=data_values["inboundDuration"],
-                outboundVolume=data_values["outboundVolume"],
-                outboundDuration=data_values["outboundDuration"],
-                averageDuration=data_values["averageDuration"],
-                volume=data_values["volume"],
-                totalDuration=data_values["totalDuration"],
-                inboundQueueVolume=data_values["inboundQueueVolume"],
-            )
-        else:
-            # Add a new record
-            app_tables.call_statistics.add_row(
-                userId=user_id,
-                userName=user_name,
-                inboundVolume=data_values["inboundVolume"],
-                inboundDuration=data_values["inboundDuration"],
-                outboundVolume=data_values["outboundVolume"],
-                outboundDuration=data_values["outboundDuration"],
-                averageDuration=data_values["averageDuration"],
-                volume=data_values["volume"],
-                totalDuration=data_values["totalDuration"],
-                inboundQueueVolume=data_values["inboundQueueVolume"],
-                reportDate=today_date,
-            )
+@tables.in_transaction
+def _write_call_statistics(data, report_date):
+    """Upsert one day's rows and apply their deltas to the derived tables.
+    
+    The stored rows the deltas are computed from are read in the same
+    transaction, so concurrent ingests of the same day can't both apply
+    the same change.
+    """
+    # Load the day's existing records once, keyed by user
+    existing_rows = {
+        row['userId']: row
+        for row in app_tables.call_statistics.search(reportDate=report_date)
+    }
+
+    new_rows = []
+    updated = 0
+    unchanged = 0
+    deltas = {}
+    facts = {}
+    period_deltas = {}
+    user_names = {}
+    with tables.batch_update:
+        for item in data.get("items", []):
+            user_id = item["userId"]
+            data_values = item["dataValues"]
+            values = {col: data_values[col] for col in CALL_STAT_COLUMNS}
+
+            existing_row = existing_rows.get(user_id)
+            if existing_row:
+                if _fingerprint(existing_row) == _fingerprint(values):
+                    # Nothing changed since the last tick - skip the write
+                    unchanged += 1
+                    continue
+            facts[user_id] = {'calls_time': values['totalDuration'], 'call_volume': values['volume']}
+            period_deltas[user_id] = column_deltas('call_statistics', existing_row, values)
+            user_names[user_id] = item["userName"]
+            if existing_row:
+                # Update the existing record
+                merge_deltas(deltas, row_deltas(CALL_TOTALS, existing_row, values))
+                existing_row.update(**values)
+                updated += 1
+            else:
+                # Queue a new record
+                merge_deltas(deltas, row_deltas(CALL_TOTALS, None, values))
+                new_rows.append(dict(values, userId=user_id, userName=item["userName"], reportDate=report_date))
+
+    if new_rows:
+        app_tables.call_statistics.add_rows(new_rows)
+
+    if new_rows or updated:
+        apply_average_deltas(report_date, deltas)
+        upsert_daily_facts(report_date, facts)
+        apply_rollup_deltas('call_statistics', report_date, period_deltas, user_names)
+    return {"added": len(new_rows), "updated": updated, "unchanged": unchanged}
 
 # ===============================================
 # Fetch Call Reports (Manual Trigger)
 # ===============================================
-@anvil.server.callable
-def fetch_call_reports():
-    global ACCESS_TOKEN
+def _request_user_activity(access_token, start, end):
+    """Request the user activity report between two UTC datetimes.
     
-    if not ACCESS_TOKEN:
-        if not initialize_auth():
-            raise Exception("Failed to initialize authorization. Please check your credentials.")
-    
-    # Calculate startTime as the start of today and endTime as the current time in UTC
-    now = datetime.utcnow()
-    start_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    start_time = start_of_today.isoformat() + "Z"
-    end_time = now.isoformat() + "Z"
+    Only makes the HTTP request and returns (status code, decoded body or
+    error text), so it can run on a worker thread; the caller finishes it
+    with _user_activity_result on its own thread.
+    """
+    start_time = start.isoformat() + "Z"
+    end_time = end.isoformat() + "Z"
 
     headers = {
-        "Authorization": f"Bearer {ACCESS_TOKEN}",
+        "Authorization": f"Bearer {access_token}",
         "Accept": "application/json"
     }
 
     url = f"{CALL_REPORTS_URL}?startTime={start_time}&endTime={end_time}"
 
-    response = requests.get(url, headers=headers)
+    response = Transport.get(url, headers=headers)
+    if response.status_code == 200:
+        return response.status_code, response.json()
+    return response.status_code, response.text
 
-    if response.status_code == 401:
-        print("Access token expired. Attempting to refresh...")
-        refresh_access_token()
-        headers["Authorization"] = f"Bearer {ACCESS_TOKEN}"
-        response = requests.get(url, headers=headers)
+def _user_activity_result(start, end, access_token, status, body):
+    """Turn a report response into its data, retrying a 401 with a refreshed token.
+    
+    access_token is the token the request was made with. Writes the tokens
+    table, so call it on the thread that owns the writes. Returns None when
+    GoTo has no data for the window.
+    """
+    if status == 401:
+        token = get_goto_token()
+        if token == access_token:
+            print("Access token expired. Attempting to refresh...")
+            token = refresh_access_token()
+        status, body = _request_user_activity(token, start, end)
 
-    if response.status_code == 200:
-        data = response.json()
-        update_call_statistics(data)
-        return {"message": "Data refreshed successfully."}
-    elif response.status_code == 404:
-        return {"message": "No data found for the specified time frame."}
+    if status in (200, 404):
+        # A working call is as good as an explicit verification
+        Tokens.mark_verified('goto')
+    if status == 200:
+        return body
+    elif status == 404:
+        return None
     else:
-        raise Exception(f"Failed to fetch call data: {response.status_code} - {response.text}")
+        raise Exception(f"Failed to fetch call data: {status} - {body}")
+
+def prepare_call_reports():
+    """Authorize and return a function that requests today's report.
+    
+    The returned function only makes the HTTP request, so the refresh job
+    can run it on a worker thread; pass its result to store_call_reports.
+    """
+    # Calculate startTime as the start of today and endTime as the current time in UTC
+    now = datetime.utcnow()
+    start_of_today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    access_token = get_goto_token()
+    return lambda: (start_of_today, now, access_token) + _request_user_activity(access_token, start_of_today, now)
+
+def store_call_reports(report):
+    """Write a report requested by prepare_call_reports' function into call_statistics"""
+    data = _user_activity_result(*report)
+    if data is None:
+        return {"message": "No data found for the specified time frame."}
+
+    counts = update_call_statistics(data)
+    return {
+        "message": "Data refreshed successfully.",
+        "changed": counts["added"] + counts["updated"],
+        "unchanged": counts["unchanged"]
+    }
+
+@anvil.server.callable
+def fetch_call_reports():
+    return store_call_reports(prepare_call_reports()())
+
+# ===============================================
+# Historical Backfill
+# ===============================================
+BACKFILL_WORKERS = 4
+
+def backfill_call_statistics(start_date, end_date, max_workers=BACKFILL_WORKERS, force=False):
+    """Fill call_statistics for every UTC day from start_date to end_date.
+    
+    Days are fetched concurrently, one report request per day, and written
+    through the bulk upsert. Each finished day is checkpointed in the
+    call_backfill_progress table, so re-running the same range resumes where
+    an interrupted run stopped. Pass force=True to fetch finished days again.
+    """
+    days = [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+    progress = {
+        row['reportDate']: row
+        for row in app_tables.call_backfill_progress.search(
+            reportDate=q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+        )
+    }
+    if not force:
+        days = [day for day in days if not (progress.get(day) and progress[day]['status'] == 'done')]
+    print(f"Backfilling call statistics for {len(days)} days from {start_date} to {end_date}")
+
+    # Authorize once up front; the workers only make the HTTP requests
+    access_token = get_goto_token()
+
+    def day_window(day):
+        start = datetime.combine(day, datetime.min.time())
+        return start, start + timedelta(days=1)
+
+    summary = {"done": 0, "failed": 0, "remaining": len(days)}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {
+            executor.submit(_request_user_activity, access_token, *day_window(day)): day
+            for day in days
+        }
+        for future in as_completed(futures):
+            day = futures[future]
+            checkpoint = {'completed_at': datetime.utcnow()}
+            try:
+                # Token refreshes and verification are table writes too,
+                # so a 401 is retried here rather than in the worker
+                data = _user_activity_result(*day_window(day), access_token, *future.result())
+                counts = update_call_statistics(data, report_date=day) if data else {"added": 0, "updated": 0}
+                checkpoint.update(status='done', rows=counts["added"] + counts["updated"])
+                summary["done"] += 1
+            except Exception as e:
+                print(f"Error backfilling {day}: {str(e)}")
+                checkpoint.update(status='failed', rows=0)
+                summary["failed"] += 1
+
+            # Table writes stay on this thread; only the HTTP fetches run in the pool
+            if day in progress:
+                progress[day].update(**checkpoint)
+            else:
+                progress[day] = app_tables.call_backfill_progress.add_row(reportDate=day, **checkpoint)
+            summary["remaining"] -= 1
+            anvil.server.task_state['progress'] = dict(summary)
+
+    print(f"Backfill complete: {summary}")
+    return summary
+
+@anvil.server.callable
+def launch_call_backfill(start_date, end_date, force=False):
+    """Start a background backfill of call_statistics and return the task ID"""
+    task = anvil.server.launch_background_task('backfill_call_statistics_task', start_date, end_date, force)
+    return task.get_id()
 
 @anvil.server.callable
 def initialize_goto_credentials(client_id, client_secret, personal_access_key):
@@ -3,11 +3,14 @@ import anvil.users
 import anvil.tables as tables
 from anvil.tables import app_tables
 import anvil.server
-import requests
+from . import Transport
+from . import Tokens
 import time
 from datetime import datetime, timedelta
 import pytz
+import csv
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from ..DataAggregation.Email import update_outlook_statistics_db
 
 # This is a server module. It runs on the Anvil server,
@@ -21,24 +24,25 @@ CLIENT_ID = anvil.secrets.get_secret("ms_client_id")
 CLIENT_SECRET = anvil.secrets.get_secret("ms_client_secret")
 TENANT_ID = anvil.secrets.get_secret("ms_tenant_id")
 
-# Cache for access token
-_access_token_cache = {
-    "token": None,
-    "expires_at": 0
-}
-
 # Add these constants at the top with the other constants
 SUPPORTED_PERIODS = ['D7', 'D30', 'D90', 'D180']
 DEFAULT_PERIOD = 'D7'  # Use 7 days as default period
+REPORT_MAX_DAYS = 30  # Graph keeps dated user detail reports for 30 days
 
-def get_access_token():
-    """Fetch an access token from Microsoft OAuth endpoint, with caching."""
-    global _access_token_cache
+# Number of concurrent requests made by fetch_user_email_stats
+EMAIL_FETCH_WORKERS = 8
+
+# Graph JSON batching - at most 20 sub-requests per $batch POST
+GRAPH_BATCH_URL = f"{MICROSOFT_GRAPH_API_BASE_URL}/$batch"
+GRAPH_BATCH_LIMIT = 20
+BATCH_MAX_RETRIES = 3
 
-    # Check if token is still valid
-    if time.time() < _access_token_cache["expires_at"]:
-        return _access_token_cache["token"]
+# How long resolved Graph user IDs (and "no account" results) are trusted
+USER_ID_TTL = timedelta(days=7)
+USER_ID_NEGATIVE_TTL = timedelta(days=1)
 
+def _request_access_token(current):
+    """Request a new client credentials token from the Microsoft OAuth endpoint"""
     token_url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     data = {
@@ -48,141 +52,318 @@ def get_access_token():
         "grant_type": "client_credentials"
     }
 
-    response = requests.post(token_url, headers=headers, data=data)
+    response = Transport.post(token_url, headers=headers, data=data)
     response.raise_for_status()
 
     token_data = response.json()
-    _access_token_cache["token"] = token_data["access_token"]
-    _access_token_cache["expires_at"] = time.time() + token_data["expires_in"] - 60  # Subtract 1 min buffer
+    return {"access_token": token_data["access_token"], "expires_in": token_data["expires_in"]}
 
-    return _access_token_cache["token"]
+def get_access_token():
+    """Return a Microsoft Graph access token, cached across server calls by the token manager."""
+    return Tokens.get_token("microsoft", _request_access_token)
 
-def get_today_messages_count(access_token, user_email):
-    """Get count of today's messages for a specific user"""
-    try:
-        print(f"\nGetting message count for: {user_email}")
-        
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "ConsistencyLevel": "eventual"
-        }
-        
-        # Get user ID first
-        search_url = f"{MICROSOFT_GRAPH_API_BASE_URL}/users?$select=id,mail&$filter=mail eq '{user_email}'"
-        print(f"Searching for user ID with URL: {search_url}")
-        
-        search_response = requests.get(search_url, headers=headers)
-        print(f"Search response status: {search_response.status_code}")
+def _today_start_str():
+    """ISO timestamp for midnight today in Central time"""
+    cst = pytz.timezone('America/Chicago')
+    today = datetime.now(cst).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today.isoformat()
+
+def _count_paths(user_id, today_str):
+    """Relative Graph paths for a user's inbox and sent counts since today_str"""
+    inbox_path = (f"/users/{user_id}/mailFolders/inbox/messages?"
+                  f"$filter=receivedDateTime ge {today_str}&$count=true&$top=1")
+    sent_path = (f"/users/{user_id}/mailFolders/sentitems/messages?"
+                 f"$filter=sentDateTime ge {today_str}&$count=true&$top=1")
+    return inbox_path, sent_path
+
+# ===============================================
+# JSON $batch
+# ===============================================
+def graph_batch(access_token, sub_requests):
+    """Send GET sub-requests through Graph $batch and return {id: response}.
+    
+    sub_requests is a list of {"id", "url"} dicts with relative URLs. They are
+    packed GRAPH_BATCH_LIMIT to a POST; sub-requests that come back throttled
+    or with a server error are retried on their own, up to BATCH_MAX_RETRIES
+    times. Sub-requests that never succeed are returned with status None.
+    """
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+    sub_headers = {
+        "ConsistencyLevel": "eventual",
+        "Prefer": "outlook.timezone=\"Central Standard Time\""
+    }
+    responses = {}
+    pending = list(sub_requests)
+
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        retry = []
+        wait = 0
+        for i in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            chunk = pending[i:i + GRAPH_BATCH_LIMIT]
+            body = {"requests": [
+                {"id": r["id"], "method": "GET", "url": r["url"], "headers": sub_headers}
+                for r in chunk
+            ]}
+            try:
+                response = Transport.post(GRAPH_BATCH_URL, headers=headers, json=body, timeout=60)
+            except Exception as e:
+                print(f"Batch request error: {str(e)}")
+                retry.extend(chunk)
+                continue
+            if response.status_code != 200:
+                print(f"Batch request failed: {response.status_code} - {response.text}")
+                retry.extend(chunk)
+                continue
+
+            by_id = {r["id"]: r for r in chunk}
+            for item in response.json().get("responses", []):
+                status = item.get("status", 0)
+                if status == 429 or status >= 500:
+                    retry_after = (item.get("headers") or {}).get("Retry-After")
+                    wait = max(wait, int(retry_after) if str(retry_after).isdigit() else 0)
+                    retry.append(by_id[item["id"]])
+                else:
+                    responses[item["id"]] = item
+
+        if not retry:
+            break
+        pending = retry
+        if attempt < BATCH_MAX_RETRIES:
+            print(f"Retrying {len(pending)} failed sub-requests")
+            # Honour Retry-After, but no longer than the transport would back off
+            time.sleep(min(Transport.BACKOFF_MAX, wait or 2 ** attempt))
+
+    for r in pending:
+        if r["id"] not in responses:
+            responses[r["id"]] = {"id": r["id"], "status": None, "body": {}}
+    return responses
+
+# ===============================================
+# Email -> Graph User ID Cache
+# ===============================================
+def resolve_user_ids(access_token, emails):
+    """Return {email: graph_id} for every email that has a Microsoft account.
+    
+    Results are persisted in the graph_user_ids table. Entries younger than
+    USER_ID_TTL are used as-is, and emails with no account are remembered for
+    USER_ID_NEGATIVE_TTL. Everything else is looked up in one batched pass.
+    """
+    now = datetime.now(pytz.utc)
+    cached = {row['email']: row for row in app_tables.graph_user_ids.search()}
+    user_ids = {}
+    to_lookup = []
+
+    for email in emails:
+        row = cached.get(email)
+        if row and row['resolved_at']:
+            ttl = USER_ID_TTL if row['found'] else USER_ID_NEGATIVE_TTL
+            if now - row['resolved_at'] < ttl:
+                if row['found']:
+                    user_ids[email] = row['graph_id']
+                continue
+        to_lookup.append(email)
+
+    print(f"Graph user IDs: {len(emails) - len(to_lookup)} cached, {len(to_lookup)} to look up")
+    if not to_lookup:
+        return user_ids
+
+    sub_requests = [
+        {"id": f"{n}-user", "url": f"/users?$select=id,mail&$filter=mail eq '{email}'"}
+        for n, email in enumerate(to_lookup)
+    ]
+    responses = graph_batch(access_token, sub_requests)
+
+    for n, email in enumerate(to_lookup):
+        response = responses.get(f"{n}-user", {})
+        if response.get("status") != 200:
+            # Transient failure - don't cache, try again next run
+            print(f"User search failed for {email}: {response.get('status')}")
+            continue
+
+        user_data = response.get("body", {}).get("value", [])
+        graph_id = user_data[0]["id"] if user_data else None
+        if graph_id:
+            user_ids[email] = graph_id
+        else:
+            print(f"No Microsoft account found for {email}")
+
+        values = {'graph_id': graph_id, 'found': bool(graph_id), 'resolved_at': now}
+        if email in cached:
+            cached[email].update(**values)
+        else:
+            app_tables.graph_user_ids.add_row(email=email, **values)
+
+    return user_ids
+
+def fetch_message_counts(access_token, user_ids, max_workers=None):
+    """Get today's inbox/sent counts for {email: graph_id} using batched requests"""
+    today_str = _today_start_str()
+    sub_requests = []
+    emails = sorted(user_ids)
+    for n, email in enumerate(emails):
+        inbox_path, sent_path = _count_paths(user_ids[email], today_str)
+        sub_requests.append({"id": f"{n}-inbox", "url": inbox_path})
+        sub_requests.append({"id": f"{n}-sent", "url": sent_path})
+
+    # Each batch is an independent POST, so run them side by side
+    batches = [sub_requests[i:i + GRAPH_BATCH_LIMIT] for i in range(0, len(sub_requests), GRAPH_BATCH_LIMIT)]
+    responses = {}
+    if batches:
+        workers = max(1, min(max_workers or EMAIL_FETCH_WORKERS, len(batches)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for batch_responses in executor.map(lambda b: graph_batch(access_token, b), batches):
+                responses.update(batch_responses)
+
+    results = []
+    for n, email in enumerate(emails):
+        inbox = responses.get(f"{n}-inbox", {})
+        sent = responses.get(f"{n}-sent", {})
+        if inbox.get("status") == 200 and sent.get("status") == 200:
+            results.append({
+                "user": email,
+                "inbox_count": inbox.get("body", {}).get('@odata.count', 0),
+                "sent_count": sent.get("body", {}).get('@odata.count', 0)
+            })
+        else:
+            print(f"Failed to get counts for {email}. Inbox: {inbox.get('status')}, Sent: {sent.get('status')}")
+    return results
+
+def prepare_email_stats(max_workers=None):
+    """Authorize, resolve Graph IDs and return a function that fetches today's counts.
+    
+    The returned function only makes HTTP requests, so the refresh job can
+    run it on a worker thread; pass its result to store_email_stats.
+    """
+    print("\n=== Starting Email Stats Fetch ===")
+    
+    access_token = get_access_token()
+    if not access_token:
+        raise Exception("Failed to get access token")
         
-        if search_response.status_code != 200:
-            print(f"User search failed: {search_response.text}")
-            return None
+    print("Access token obtained successfully")
+    
+    # Simplified query to just get email addresses
+    rows = app_tables.users.search(tables.order_by("email"))
+    valid_users = []
+    
+    for row in rows:
+        email = row['email']
+        if email and isinstance(email, str):
+            valid_users.append({"email": email.strip().lower()})
+            print(f"Found valid email: {email}")
             
-        user_data = search_response.json().get("value", [])
-        if not user_data:
-            print(f"No Microsoft account found for {user_email}")
-            return None
-            
-        user_id = user_data[0]["id"]
-        print(f"Found user ID: {user_id}")
-        
-        # Get message counts for today
-        cst = pytz.timezone('America/Chicago')
-        today = datetime.now(cst).replace(hour=0, minute=0, second=0, microsecond=0)
-        today_str = today.isoformat()
-        
-        # Build filter queries
-        inbox_url = (f"{MICROSOFT_GRAPH_API_BASE_URL}/users/{user_id}/mailFolders/inbox/messages?"
-                    f"$filter=receivedDateTime ge {today_str}&$count=true&$top=1")
-        sent_url = (f"{MICROSOFT_GRAPH_API_BASE_URL}/users/{user_id}/mailFolders/sentitems/messages?"
-                    f"$filter=sentDateTime ge {today_str}&$count=true&$top=1")
-        
-        # Add prefer header for count
-        headers["Prefer"] = "outlook.timezone=\"Central Standard Time\""
-        
-        print("Fetching inbox count...")
-        inbox_response = requests.get(inbox_url, headers=headers)
-        print("Fetching sent items count...")
-        sent_response = requests.get(sent_url, headers=headers)
+    print(f"Found {len(valid_users)} valid email addresses")
+    
+    # Graph IDs come from the persisted cache; only unknown or expired
+    # emails are looked up, in bulk
+    user_ids = resolve_user_ids(access_token, [user['email'] for user in valid_users])
+
+    # Inbox and sent counts for all users go out as $batch requests
+    def fetch():
+        results = fetch_message_counts(access_token, user_ids, max_workers)
+        if user_ids and not results:
+            raise Exception(f"Failed to get message counts for all {len(user_ids)} users")
+        return results
+    return fetch
+
+def store_email_stats(results):
+    """Write counts fetched by prepare_email_stats' function into outlook_statistics"""
+    print(f"\nSuccessfully processed {len(results)} users")
+    
+    if results:
+        success = update_outlook_statistics_db(results)
+        if not success:
+            raise Exception("Failed to update outlook_statistics")
+    
+    return results
+
+@anvil.server.callable
+def fetch_user_email_stats(max_workers=None):
+    """Fetch email statistics for all users, max_workers requests at a time"""
+    try:
+        return store_email_stats(prepare_email_stats(max_workers)())
         
-        if inbox_response.status_code == 200 and sent_response.status_code == 200:
-            inbox_data = inbox_response.json()
-            sent_data = sent_response.json()
-            
-            inbox_count = inbox_data.get('@odata.count', 0)
-            sent_count = sent_data.get('@odata.count', 0)
-            
-            return {
-                "user": user_email,
-                "inbox_count": inbox_count,
-                "sent_count": sent_count
-            }
-        else:
-            print(f"Failed to get counts. Inbox: {inbox_response.status_code}, Sent: {sent_response.status_code}")
-            print(f"Inbox response: {inbox_response.text}")
-            print(f"Sent response: {sent_response.text}")
-            return None
-            
     except Exception as e:
-        print(f"Error getting message counts for {user_email}: {str(e)}")
-        print(f"Full error details: {repr(e)}")
+        print(f"Error fetching email stats: {str(e)}")
+        import traceback
+        print(f"Stack trace:\n{traceback.format_exc()}")
+        return []
+
+# ===============================================
+# Org-wide Email Activity Report
+# ===============================================
+def _download_activity_report(access_token, report_date):
+    """Download the tenant-wide email activity user detail CSV for one day"""
+    url = f"{MICROSOFT_GRAPH_API_BASE_URL}/reports/getEmailActivityUserDetail(date={report_date.isoformat()})"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    
+    # Graph answers with a redirect to a pre-authenticated CSV download
+    response = Transport.get(url, headers=headers, timeout=60)
+    if response.status_code != 200:
+        print(f"Report download failed for {report_date}: {response.status_code} - {response.text}")
         return None
+    return response.content.decode('utf-8-sig')
 
 @anvil.server.callable
-def fetch_user_email_stats():
-    """Fetch email statistics for all users"""
+def ingest_email_activity_report(period=DEFAULT_PERIOD):
+    """Backfill outlook_statistics for every day in period from the Graph usage reports.
+    
+    Each day is one CSV covering every mailbox in the tenant, instead of one
+    pair of count queries per user per day. Graph only keeps the per-day
+    report for the last REPORT_MAX_DAYS days, so longer periods are capped.
+    """
     try:
-        print("\n=== Starting Email Stats Fetch ===")
-        
-        access_token = get_access_token()
-        if not access_token:
-            raise Exception("Failed to get access token")
+        if period not in SUPPORTED_PERIODS:
+            raise ValueError(f"Unsupported period {period}, expected one of {SUPPORTED_PERIODS}")
             
-        print("Access token obtained successfully")
+        print(f"\n=== Starting Email Activity Report Ingest ({period}) ===")
+        access_token = get_access_token()
         
-        # Simplified query to just get email addresses
-        rows = app_tables.users.search(tables.order_by("email"))
-        valid_users = []
+        # Only store users that exist in the app, like fetch_user_email_stats
+        app_users = {
+            row['email'].strip().lower()
+            for row in app_tables.users.search()
+            if row['email'] and isinstance(row['email'], str)
+        }
         
-        for row in rows:
-            email = row['email']
-            if email and isinstance(email, str):
-                valid_users.append({"email": email.strip().lower()})
-                print(f"Found valid email: {email}")
-                
-        print(f"Found {len(valid_users)} valid email addresses")
+        days = min(int(period[1:]), REPORT_MAX_DAYS)
+        if days < int(period[1:]):
+            print(f"Per-day reports only cover {REPORT_MAX_DAYS} days, ingesting the last {days}")
+        today = datetime.now(pytz.timezone('America/Chicago')).date()
         
-        results = []
-        successful_fetches = 0
-
-        for user in valid_users:
-            try:
-                email = user['email']
-                print(f"\nProcessing user: {email}")
-                
-                user_stats = get_today_messages_count(access_token, email)
-                if user_stats:
-                    results.append(user_stats)
-                    successful_fetches += 1
-                    
-            except Exception as user_error:
-                print(f"Error processing user {email}: {str(user_error)}")
+        ingested = {}
+        for offset in range(1, days + 1):
+            report_date = today - timedelta(days=offset)
+            text = _download_activity_report(access_token, report_date)
+            if text is None:
                 continue
                 
-        print(f"\nSuccessfully processed {successful_fetches} users")
-        
-        if results:
-            success = update_outlook_statistics_db(results)
-            if not success:
-                print("Warning: Database update returned False")
-        
-        return results
+            results = []
+            for record in csv.DictReader(StringIO(text)):
+                email = (record.get('User Principal Name') or '').strip().lower()
+                if email not in app_users:
+                    continue
+                results.append({
+                    "user": email,
+                    "inbox_count": int(record.get('Receive Count') or 0),
+                    "sent_count": int(record.get('Send Count') or 0)
+                })
+                
+            if results:
+                update_outlook_statistics_db(results, report_date)
+            ingested[report_date.isoformat()] = len(results)
+            
+        print(f"Ingested activity report for {len(ingested)} days")
+        return ingested
         
     except Exception as e:
-        print(f"Error fetching email stats: {str(e)}")
+        print(f"Error ingesting email activity report: {str(e)}")
         import traceback
         print(f"Stack trace:\n{traceback.format_exc()}")
-        return []
+        return {}
 
 # Remove parse_csv_response function as it's no longer needed
 
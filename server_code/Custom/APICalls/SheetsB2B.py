@@ -4,116 +4,243 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
-import requests
+from . import Transport
 import json
-from datetime import datetime
+import hashlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from ..DataAggregation.Rollups import (
+    apply_b2b_daily, b2b_rows_between, period_start, rebuild_b2b_daily_range
+)
 
-def fetch_google_sheet_data(sales_rep=None, complete=None):
-    api_key = anvil.secrets.get_secret("5Up3rS3cr3t_K3y!2024#@Xz")
+SHEET_URL = "https://script.google.com/macros/s/AKfycbzrm6ttNyYRxfibYUHYExxlWruT33m1gXdDRZFo4hLFap0zkmhutKKkHdpQNW27GdS4Yw/exec"
+SHEET_TIMEOUT = 30
+PROMO_COLUMN = 'Promotional Material the customer would like?'
+
+# ===============================================
+# Sheet Download
+# ===============================================
+# The B2B reports read the b2b table and its rollups, so the import is the
+# only reader of the sheet. Each run downloads it once and the import is
+# skipped when the content hash matches the last imported one.
+
+def parse_sheet_row(row):
+    """Normalise a raw sheet row into the fields the B2B readers use"""
+    timestamp_str = (row.get('Timestamp') or '').strip()
+    promo = row.get(PROMO_COLUMN) or row.get('C1') or ''
+    return {
+        'timestamp': parse_timestamp(timestamp_str) if timestamp_str else None,
+        'sales_rep': (row.get('Sales Rep') or '').strip(),
+        'promo': promo.strip().lower(),
+        'complete': bool(row.get('Complete', False)),
+        'raw': row
+    }
+
+def _download_sheet():
+    """Download the sheet once and return (content hash, decoded JSON)"""
+    api_key = anvil.secrets.get_secret("b2b_sheets_secret")
+    print(f"Downloading B2B sheet from: {SHEET_URL}")
+    response = Transport.get(SHEET_URL, params={"key": api_key}, timeout=SHEET_TIMEOUT)
+    print(f"Response status code: {response.status_code}")
+
+    if response.status_code != 200:
+        print(f"Error response: {response.text}")
+        raise Exception(f"API request failed with status {response.status_code}")
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    return content_hash, response
+
+def _with_row_keys(rows):
+    """Give each parsed row a key from its content and its occurrence among identical rows.
     
-    print("Fetching data from Google Sheets...")
+    Identical submissions are genuine repeats, so they get distinct keys
+    instead of collapsing into one.
+    """
+    occurrences = Counter()
+    for row in rows:
+        digest = hashlib.sha1(json.dumps(row['raw'], sort_keys=True, default=str).encode()).hexdigest()
+        occurrences[digest] += 1
+        row['key'] = f"{digest}:{occurrences[digest]}"
+    return rows
+
+def get_sheet_rows():
+    """Download the sheet and return (content hash, parsed rows with their row keys)"""
+    content_hash, response = _download_sheet()
+    rows = _with_row_keys([parse_sheet_row(row) for row in response.json()])
+    print(f"Sheet has {len(rows)} records")
+    return content_hash, rows
+
+def parse_timestamp(timestamp_str):
+    """Parse timestamp string from Google Sheets to datetime object"""
+    # Assuming format like "9/11/2024 10:06:35", older rows use ISO dates
+    for fmt in ("%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(timestamp_str, fmt)
+        except ValueError:
+            continue
+    print(f"Error parsing timestamp {timestamp_str}")
+    return None
+
+# ===============================================
+# Incremental Import into the b2b Table
+# ===============================================
+IMPORT_BATCH_SIZE = 100
+
+# Rows are matched to the sheet by row_key, a hash of the raw sheet row plus
+# its occurrence, so repeated submissions and rows without a sales rep are
+# all kept. Rows from before row_key existed were keyed on (timestamp, rep)
+# and classified from the 'C1' cell; reimport_sheet_history replaces them.
+
+def _as_naive(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def _get_import_state():
+    """Return the single b2b_import_state row, creating it on first use"""
+    for row in app_tables.b2b_import_state.search():
+        return row
+    return app_tables.b2b_import_state.add_row(
+        high_water_mark=None, sheet_hash=None, last_run=None, last_added=0
+    )
+
+def _b2b_values(row):
+    """b2b table values for a parsed sheet row"""
+    marketing_type = row['promo']
+    return {
+        'timestamp': row['timestamp'],
+        'sales_rep': row['sales_rep'],
+        'complete': row['complete'],
+        'email': 'email' in marketing_type,
+        'flyers': 'flyer' in marketing_type,
+        'business_cards': 'business card' in marketing_type,
+        'row_key': row['key']
+    }
+
+@tables.in_transaction
+def _import_sheet_rows(sheet_rows, sheet_hash, incremental):
+    """Insert the sheet rows not yet in b2b, roll them up and advance the mark.
     
-    url = "https://script.google.com/macros/s/AKfycbzrm6ttNyYRxfibYUHYExxlWruT33m1gXdDRZFo4hLFap0zkmhutKKkHdpQNW27GdS4Yw/exec"
+    All in one transaction, so a failed rollup can't leave inserted rows
+    that later runs treat as already imported.
+    """
+    state = _get_import_state()
+    high_water_mark = state['high_water_mark'] if incremental else None
+    if high_water_mark is not None:
+        high_water_mark = _as_naive(high_water_mark)
+    print(f"Processing {len(sheet_rows)} records from sheet (high-water mark: {high_water_mark})")
     
-    params = {
-        "key": api_key
-    }
+    # Load the keys we already have in one pass
+    if high_water_mark is not None:
+        existing_rows = app_tables.b2b.search(timestamp=q.greater_than_or_equal_to(high_water_mark))
+    else:
+        existing_rows = app_tables.b2b.search()
+    seen = set()
+    legacy = Counter()
+    for row in existing_rows:
+        if row['row_key']:
+            seen.add(row['row_key'])
+        else:
+            legacy[(_as_naive(row['timestamp']), row['sales_rep'] or '')] += 1
     
-    try:
-        print(f"Making API request to: {url}")  # Debug log
-        print(f"With parameters: {params}")      # Debug log
-        
-        response = requests.get(url, params=params, timeout=30)
-        print(f"Response status code: {response.status_code}")  # Debug log
+    new_rows = []
+    # A full re-check must never move the mark backwards or clear it
+    newest = state['high_water_mark']
+    if newest is not None:
+        newest = _as_naive(newest)
+    for row in sheet_rows:
+        timestamp = row['timestamp']
+        if timestamp is None:
+            continue
+        if high_water_mark is not None and timestamp < high_water_mark:
+            continue
+        if row['key'] in seen:
+            continue
+        legacy_key = (timestamp, row['sales_rep'])
+        if legacy[legacy_key]:
+            # Already imported before rows were keyed
+            legacy[legacy_key] -= 1
+            continue
+        seen.add(row['key'])
         
-        if response.status_code != 200:
-            print(f"Error response: {response.text}")  # Debug log
-            raise Exception(f"API request failed with status {response.status_code}")
-            
-        data = response.json()
-        print(f"Response data: {data[:2]}")  # Debug log first two records
-        print(f"Received {len(data)} records from sheet")
-        return data
-        
-    except Exception as e:
-        print(f"Error fetching sheet data: {str(e)}")
-        print(f"Full error details: {repr(e)}")  # More detailed error info
-        raise
+        new_rows.append(_b2b_values(row))
+        if newest is None or timestamp > newest:
+            newest = timestamp
+    
+    # Insert new records in batches
+    for i in range(0, len(new_rows), IMPORT_BATCH_SIZE):
+        app_tables.b2b.add_rows(new_rows[i:i + IMPORT_BATCH_SIZE])
+    apply_b2b_daily(new_rows)
+    
+    state.update(
+        high_water_mark=newest, sheet_hash=sheet_hash,
+        last_run=datetime.now(), last_added=len(new_rows)
+    )
+    
+    return len(new_rows)
 
-def parse_timestamp(timestamp_str):
-    """Parse timestamp string from Google Sheets to datetime object"""
-    try:
-        # Assuming format like "9/11/2024 10:06:35"
-        return datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S")
-    except ValueError as e:
-        print(f"Error parsing timestamp {timestamp_str}: {e}")
-        return None
+@tables.in_transaction
+def _reimport_month(month_start, sheet_rows):
+    """Replace one month's unkeyed b2b rows with the sheet's, and recount its b2b_daily"""
+    month_end = period_start('month', month_start + timedelta(days=31)) - timedelta(days=1)
+    keyed = set()
+    for row in b2b_rows_between(month_start, month_end):
+        if row['row_key']:
+            keyed.add(row['row_key'])
+        else:
+            row.delete()
+    new_rows = [_b2b_values(row) for row in sheet_rows if row['key'] not in keyed]
+    for i in range(0, len(new_rows), IMPORT_BATCH_SIZE):
+        app_tables.b2b.add_rows(new_rows[i:i + IMPORT_BATCH_SIZE])
+    rebuild_b2b_daily_range(month_start, month_end)
+    return len(new_rows)
+
+def reimport_sheet_history():
+    """Reclassify the b2b history from the sheet and rebuild b2b_daily, a month per transaction.
+    
+    Rows are classified from PROMO_COLUMN, as the live sheet readers did.
+    Rows the import has already keyed are kept, so a concurrent import is
+    neither undone nor duplicated.
+    """
+    _, sheet_rows = get_sheet_rows()
+    months = {}
+    for row in sheet_rows:
+        if row['timestamp'] is not None:
+            months.setdefault(period_start('month', row['timestamp'].date()), []).append(row)
+    # Months holding only old rows still need those rows replaced
+    for row in app_tables.b2b.search(row_key=None):
+        months.setdefault(period_start('month', _as_naive(row['timestamp']).date()), [])
+    
+    added = 0
+    for month_start in sorted(months):
+        added += _reimport_month(month_start, months[month_start])
+    print(f"Re-imported B2B history for {len(months)} months, {added} rows from the sheet")
+    return added
 
 @anvil.server.callable
-def process_and_store_sheet_data():
+def process_and_store_sheet_data(incremental=True):
+    """Import new sheet rows into the b2b table.
+    
+    In incremental mode rows older than the stored high-water mark are skipped
+    without touching the database, and the rows at or after it are checked
+    against a key set loaded in a single search.
+    """
     try:
-        # Fetch the data from Google Sheets
         print("Starting process_and_store_sheet_data")  # Debug log
-        sheet_data = fetch_google_sheet_data()
+        sheet_hash, sheet_rows = get_sheet_rows()
         
-        if not sheet_data:
+        if not sheet_rows:
             print("No data received from sheet")
             return 0
             
-        print(f"Processing {len(sheet_data)} records from sheet")
-        
-        new_records_count = 0
-        
-        # Process each row
-        for row in sheet_data:
-            try:
-                timestamp_str = row.get('Timestamp')
-                if not timestamp_str:
-                    print(f"Skipping row - no timestamp: {row}")
-                    continue
-                    
-                timestamp = parse_timestamp(timestamp_str)
-                if not timestamp:
-                    continue
-                
-                sales_rep = row.get('Sales Rep')
-                if not sales_rep:
-                    print(f"Skipping row - no sales rep: {row}")
-                    continue
-                
-                # Check for existing record
-                existing = app_tables.b2b.get(
-                    timestamp=timestamp,
-                    sales_rep=sales_rep
-                )
-                
-                if existing:
-                    print(f"Record exists for {sales_rep} at {timestamp}")
-                    continue
-                
-                # Process marketing type
-                marketing_type = row.get('C1', '').strip().lower()
-                print(f"Processing marketing type: {marketing_type}")
-                
-                # Add new record
-                app_tables.b2b.add_row(
-                    timestamp=timestamp,
-                    sales_rep=sales_rep,
-                    complete=bool(row.get('Complete', False)),  # Ensure boolean
-                    email='email' in marketing_type,
-                    flyers='flyer' in marketing_type,
-                    business_cards='business card' in marketing_type
-                )
-                
-                new_records_count += 1
-                print(f"Added new record for {sales_rep}")
-                
-            except Exception as row_error:
-                print(f"Error processing row: {row_error}")
-                continue
-        
-        print(f"Import complete. Added {new_records_count} new records")
-        return new_records_count
+        state = _get_import_state()
+        if incremental and sheet_hash == state['sheet_hash']:
+            print("B2B sheet unchanged since the last import, nothing to do")
+            state.update(last_run=datetime.now(), last_added=0)
+            return 0
+        added = _import_sheet_rows(sheet_rows, sheet_hash, incremental)
+        print(f"Import complete. Added {added} new records")
+        return added
         
     except Exception as e:
         print(f"Error in process_and_store_sheet_data: {e}")
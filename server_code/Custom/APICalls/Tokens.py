@@ -0,0 +1,116 @@
+from anvil.tables import app_tables
+import threading
+from datetime import datetime, timedelta, timezone
+
+# Token manager shared by the GoTo and Microsoft Graph clients.
+#
+# Tokens, their expiry and when they were last verified are kept in memory
+# and persisted to the token_cache table, so a fresh server call picks up
+# the previous call's token instead of requesting or verifying a new one.
+# get_token() refreshes proactively once a token is within REFRESH_MARGIN
+# of expiring, with one refresh in flight per provider.
+
+REFRESH_MARGIN = timedelta(minutes=5)
+VERIFICATION_TTL = timedelta(hours=12)
+
+_memory = {}
+_locks = {}
+_locks_guard = threading.Lock()
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _provider_lock(provider):
+    with _locks_guard:
+        return _locks.setdefault(provider, threading.Lock())
+
+def get_entry(provider):
+    """Return the cached entry for provider, reading the table on a memory miss"""
+    entry = _memory.get(provider)
+    if entry is None:
+        row = app_tables.token_cache.get(provider=provider)
+        if row is None:
+            return None
+        entry = {
+            'access_token': row['access_token'],
+            'refresh_token': row['refresh_token'],
+            'expires_at': row['expires_at'],
+            'verified_at': row['verified_at']
+        }
+        _memory[provider] = entry
+    return entry
+
+def _save(provider, entry):
+    _memory[provider] = entry
+    row = app_tables.token_cache.get(provider=provider)
+    if row:
+        row.update(**entry)
+    else:
+        app_tables.token_cache.add_row(provider=provider, **entry)
+
+def is_fresh(entry):
+    """True if the entry has a token that isn't about to expire"""
+    if not entry or not entry['access_token']:
+        return False
+    return entry['expires_at'] is None or entry['expires_at'] - REFRESH_MARGIN > _now()
+
+def get_cached(provider):
+    """Return the cached entry for provider if its token is still fresh, else None"""
+    entry = get_entry(provider)
+    return entry if is_fresh(entry) else None
+
+def is_verified(provider):
+    """True if the provider's token passed verification within VERIFICATION_TTL"""
+    entry = get_cached(provider)
+    return bool(entry and entry['verified_at'] and _now() - entry['verified_at'] < VERIFICATION_TTL)
+
+def store_token(provider, access_token, expires_in=None, refresh_token=None, verified=False):
+    """Persist a token; expires_in is in seconds, None for tokens without expiry"""
+    previous = get_entry(provider) or {}
+    entry = {
+        'access_token': access_token,
+        'refresh_token': refresh_token or previous.get('refresh_token'),
+        'expires_at': _now() + timedelta(seconds=expires_in) if expires_in else None,
+        'verified_at': _now() if verified else None
+    }
+    _save(provider, entry)
+    return entry
+
+def mark_verified(provider):
+    """Record that the provider's current token just worked against the API"""
+    entry = get_entry(provider)
+    if entry and entry['access_token']:
+        _save(provider, dict(entry, verified_at=_now()))
+
+def invalidate(provider):
+    """Forget the provider's token, keeping any refresh token"""
+    entry = get_entry(provider)
+    if entry:
+        _save(provider, dict(entry, access_token=None, expires_at=None, verified_at=None))
+
+def get_token(provider, fetch):
+    """Return a fresh token for provider, calling fetch() to obtain a new one if needed.
+    
+    fetch receives the current entry (or None) and returns a dict with
+    access_token and optionally expires_in, refresh_token and verified.
+    """
+    entry = get_cached(provider)
+    if entry:
+        return entry['access_token']
+
+    with _provider_lock(provider):
+        # Another thread may have refreshed while we waited
+        entry = get_cached(provider)
+        if entry:
+            return entry['access_token']
+
+        token = fetch(get_entry(provider))
+        entry = store_token(
+            provider,
+            token['access_token'],
+            expires_in=token.get('expires_in'),
+            refresh_token=token.get('refresh_token'),
+            verified=token.get('verified', True)
+        )
+        print(f"Obtained new {provider} token")
+        return entry['access_token']
@@ -0,0 +1,80 @@
+import requests
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+# Shared HTTP transport for the GoTo, Microsoft Graph and Google Sheets clients.
+# Keeps one pooled keep-alive Session per upstream host, applies a default
+# timeout to every call and retries throttled or failed requests with
+# jittered exponential backoff, honouring Retry-After.
+
+DEFAULT_TIMEOUT = (5, 30)  # (connect, read) seconds
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.5  # seconds
+BACKOFF_MAX = 30  # seconds
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POOL_SIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(url):
+    """Return the pooled Session for the URL's host, creating it on first use"""
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff for the given attempt number"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+def _retry_after(response):
+    """Seconds to wait from a Retry-After header, or None if absent or unreadable"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def request(method, url, retries=MAX_RETRIES, **kwargs):
+    """Make an HTTP request through the shared session with timeout and retries"""
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    session = get_session(url)
+
+    for attempt in range(retries + 1):
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay = _backoff(attempt)
+            print(f"{method} {urlparse(url).netloc} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            retry_after = _retry_after(response)
+            delay = min(BACKOFF_MAX, retry_after) if retry_after is not None else _backoff(attempt)
+            print(f"{method} {urlparse(url).netloc} returned {response.status_code}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -4,10 +4,17 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 
 # Import the main functions from their respective modules
-from .APICalls.GoTo import fetch_call_reports, initialize_auth
-from .APICalls.Outlook import fetch_user_email_stats
+from .APICalls.GoTo import (
+    fetch_call_reports, initialize_auth, backfill_call_statistics,
+    prepare_call_reports, store_call_reports
+)
+from .APICalls.Outlook import fetch_user_email_stats, prepare_email_stats, store_email_stats
+from .APICalls.SheetsB2B import process_and_store_sheet_data
+from .DataAggregation.AverageRep import recalculate_todays_averages, warm_sales_dashboards
 
 @anvil.server.background_task
 def fetch_call_reports_scheduled():
@@ -22,6 +29,151 @@ def fetch_call_reports_scheduled():
             else:
                 print("Failed to reinitialize authorization")
 
+@anvil.server.background_task
+def backfill_call_statistics_task(start_date, end_date, force=False):
+    return backfill_call_statistics(start_date, end_date, force=force)
+
 @anvil.server.background_task
 def fetch_user_email_stats_scheduled():
     fetch_user_email_stats()
+
+
+@anvil.server.background_task
+def process_and_store_sheet_data_scheduled():
+    process_and_store_sheet_data()
+
+# ===============================================
+# Manual Refresh Job
+# ===============================================
+# The GoTo and Graph ingests are independent, so their HTTP fetches run side
+# by side on worker threads, while every table write - tokens, statistics and
+# derived tables - stays on the task thread. The averages are recalculated
+# once both have finished. Each stage's status ('pending', 'running', 'done'
+# or 'failed') is published on the run's refresh_runs row and in task_state.
+#
+# Refreshes are single-flight across users: a request made while a run is in
+# progress, or within REFRESH_REUSE_SECONDS of one finishing, attaches to
+# that run instead of starting another.
+
+# stage -> (prepare, store): prepare returns the HTTP-only fetch, store writes its result
+REFRESH_INGESTS = {
+    'calls': (prepare_call_reports, store_call_reports),
+    'emails': (prepare_email_stats, store_email_stats)
+}
+REFRESH_REUSE_SECONDS = 60
+REFRESH_STALE_AFTER = timedelta(minutes=10)  # a 'running' run older than this is presumed dead
+
+def _now():
+    return datetime.now(timezone.utc)
+
+@tables.in_transaction
+def _claim_refresh_run():
+    """Return (run, started) - the run to attach to, and whether this request created it"""
+    latest = next(iter(app_tables.refresh_runs.search(tables.order_by('started', ascending=False))), None)
+    if latest:
+        if latest['status'] == 'running' and _now() - latest['started'] < REFRESH_STALE_AFTER:
+            latest['requesters'] = (latest['requesters'] or 0) + 1
+            return latest, False
+        if (latest['status'] == 'done'
+                and (_now() - latest['finished']).total_seconds() < REFRESH_REUSE_SECONDS):
+            latest['requesters'] = (latest['requesters'] or 0) + 1
+            return latest, False
+
+    run = app_tables.refresh_runs.add_row(
+        status='running',
+        stages={'calls': 'pending', 'emails': 'pending', 'averages': 'pending'},
+        started=_now(),
+        requesters=1
+    )
+    return run, True
+
+@anvil.server.background_task
+def refresh_all_data_task(run_id):
+    run = app_tables.refresh_runs.get_by_id(run_id)
+    stages = dict(run['stages'])
+    def publish():
+        anvil.server.task_state['stages'] = dict(stages)
+        run['stages'] = dict(stages)
+
+    try:
+        fetches = {}
+        for stage, (prepare, _) in REFRESH_INGESTS.items():
+            stages[stage] = 'running'
+            try:
+                fetches[stage] = prepare()
+            except Exception as e:
+                print(f"Error refreshing {stage}: {e}")
+                stages[stage] = 'failed'
+        publish()
+
+        with ThreadPoolExecutor(max_workers=len(REFRESH_INGESTS)) as executor:
+            futures = {executor.submit(fetch): stage for stage, fetch in fetches.items()}
+            for future in as_completed(futures):
+                stage = futures[future]
+                try:
+                    REFRESH_INGESTS[stage][1](future.result())
+                    stages[stage] = 'done'
+                except Exception as e:
+                    print(f"Error refreshing {stage}: {e}")
+                    stages[stage] = 'failed'
+                publish()
+
+        stages['averages'] = 'running'
+        publish()
+        stages['averages'] = 'done' if recalculate_todays_averages() else 'failed'
+        publish()
+        # Serve the refreshed numbers from the Sales landing page straight away;
+        # the data itself is refreshed, so a failure here doesn't fail the run
+        try:
+            warm_sales_dashboards()
+        except Exception as e:
+            print(f"Error warming sales dashboards: {e}")
+        status = 'failed' if 'failed' in stages.values() else 'done'
+    except Exception as e:
+        print(f"Error in data refresh: {e}")
+        status = 'failed'
+
+    run.update(status=status, finished=_now())
+    return stages
+
+@anvil.server.callable
+def launch_data_refresh():
+    """Start a background refresh of calls, emails and averages, or join the current one.
+    
+    Returns the refresh run's ID for polling with get_data_refresh_status.
+    """
+    run, started = _claim_refresh_run()
+    if started:
+        try:
+            anvil.server.launch_background_task('refresh_all_data_task', run.get_id())
+        except Exception as e:
+            # Don't leave a 'running' run behind for later requests to attach to
+            print(f"Error launching data refresh: {e}")
+            run.update(status='failed', finished=_now())
+            raise
+        print("Started a new data refresh")
+    else:
+        print(f"Attached to data refresh started at {run['started']} ({run['status']})")
+    return run.get_id()
+
+@anvil.server.callable
+def get_data_refresh_status(run_id):
+    """Return a refresh run's status, per-stage progress and the last completed refresh time"""
+    run = app_tables.refresh_runs.get_by_id(run_id)
+    status = run['status'] if run else 'missing'
+    if status == 'running' and _now() - run['started'] >= REFRESH_STALE_AFTER:
+        # The task died without recording a result
+        status = 'failed'
+    return {
+        'status': status,
+        'stages': dict(run['stages'] or {}) if run else {},
+        'last_refreshed': get_last_refreshed()
+    }
+
+@anvil.server.callable
+def get_last_refreshed():
+    """When the most recent successful manual refresh finished, or None"""
+    latest = next(iter(app_tables.refresh_runs.search(
+        tables.order_by('finished', ascending=False), status='done'
+    )), None)
+    return latest['finished'] if latest else None
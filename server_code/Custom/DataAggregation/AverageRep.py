@@ -4,264 +4,42 @@ import anvil.tables as tables
 import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
-from datetime import datetime
-import requests
+from datetime import datetime, timedelta, timezone
+import pytz
+from .Rollups import (
+    AVERAGE_METRICS, B2B_TOTALS, CALL_TOTALS, EMAIL_TOTALS, get_average_totals,
+    get_daily_facts, mark_dates_dirty, pop_dirty_dates, rebuild_average_totals
+)
 
-def get_b2b_stats_for_today():
-    """Get B2B statistics from Google Sheet for today"""
-    try:
-        today = datetime.now().date()
-        api_key = anvil.secrets.get_secret("b2b_sheets_secret")
-        url = "https://script.google.com/macros/s/AKfycbzrm6ttNyYRxfibYUHYExxlWruT33m1gXdDRZFo4hLFap0zkmhutKKkHdpQNW27GdS4Yw/exec"
-        
-        response = requests.get(
-            url,
-            params={"key": api_key},
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            print(f"API request failed: {response.status_code}")
-            return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-            
-        sheet_data = response.json()
-        today_str = today.strftime("%Y-%m-%d")
-        
-        # Initialize counters
-        totals = {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-        count = 0
-        
-        for row in sheet_data:
-            try:
-                timestamp_str = row.get('Timestamp', '').strip()
-                if not timestamp_str:
-                    continue
-                    
-                try:
-                    timestamp = datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S")
-                except ValueError:
-                    try:
-                        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        continue
-                        
-                if timestamp.date() == today:
-                    promo_material = row.get('Promotional Material the customer would like?', '').lower()
-                    if 'business card' in promo_material:
-                        totals['business_cards'] += 1
-                    if 'flyer' in promo_material:
-                        totals['flyers'] += 1
-                    if 'email' in promo_material:
-                        totals['b2b_emails'] += 1
-                    count += 1
-                    
-            except Exception as row_error:
-                print(f"Error processing B2B row: {str(row_error)}")
-                continue
-                
-        # Calculate averages
-        if count > 0:
-            return {k: v/count for k, v in totals.items()}
-        return totals
-        
-    except Exception as e:
-        print(f"Error getting B2B stats: {e}")
-        return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-
-def get_b2b_stats_for_user(user_email):
-    """Get B2B statistics from Google Sheet for a specific user"""
-    try:
-        today = datetime.now().date()
-        api_key = anvil.secrets.get_secret("b2b_sheets_secret")
-        url = "https://script.google.com/macros/s/AKfycbzrm6ttNyYRxfibYUHYExxlWruT33m1gXdDRZFo4hLFap0zkmhutKKkHdpQNW27GdS4Yw/exec"
-        
-        response = requests.get(
-            url,
-            params={"key": api_key},
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-            
-        sheet_data = response.json()
-        
-        # Initialize counters
-        totals = {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-        
-        for row in sheet_data:
-            try:
-                if row.get('Sales Rep', '').strip().lower() != user_email.lower():
-                    continue
-                    
-                timestamp_str = row.get('Timestamp', '').strip()
-                if not timestamp_str:
-                    continue
-                    
-                try:
-                    timestamp = datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S")
-                except ValueError:
-                    try:
-                        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        continue
-                        
-                if timestamp.date() == today:
-                    promo_material = row.get('Promotional Material the customer would like?', '').lower()
-                    if 'business card' in promo_material:
-                        totals['business_cards'] += 1
-                    if 'flyer' in promo_material:
-                        totals['flyers'] += 1
-                    if 'email' in promo_material:
-                        totals['b2b_emails'] += 1
-                    
-            except Exception as row_error:
-                print(f"Error processing B2B row: {str(row_error)}")
-                continue
-                
-        return totals
-        
-    except Exception as e:
-        print(f"Error getting user B2B stats: {e}")
-        return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-
-def get_b2b_stats_for_date_range(start_date, end_date):
-    """Get B2B statistics from Google Sheet for date range"""
-    try:
-        api_key = anvil.secrets.get_secret("b2b_sheets_secret")
-        url = "https://script.google.com/macros/s/AKfycbzrm6ttNyYRxfibYUHYExxlWruT33m1gXdDRZFo4hLFap0zkmhutKKkHdpQNW27GdS4Yw/exec"
-        
-        response = requests.get(
-            url,
-            params={"key": api_key},
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-            
-        sheet_data = response.json()
-        totals = {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
-        count = 0
-        
-        for row in sheet_data:
-            try:
-                timestamp_str = row.get('Timestamp', '').strip()
-                if not timestamp_str:
-                    continue
-                    
-                try:
-                    timestamp = datetime.strptime(timestamp_str, "%m/%d/%Y %H:%M:%S")
-                except ValueError:
-                    try:
-                        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                    except ValueError:
-                        continue
-                        
-                if start_date <= timestamp.date() <= end_date:
-                    promo_material = row.get('Promotional Material the customer would like?', '').lower()
-                    if 'business card' in promo_material:
-                        totals['business_cards'] += 1
-                    if 'flyer' in promo_material:
-                        totals['flyers'] += 1
-                    if 'email' in promo_material:
-                        totals['b2b_emails'] += 1
-                    count += 1
-                    
-            except Exception as row_error:
-                print(f"Error processing B2B row: {str(row_error)}")
-                continue
-                
-        if count > 0:
-            return {k: v/count for k, v in totals.items()}
-        return totals
-        
-    except Exception as e:
-        print(f"Error getting B2B stats: {e}")
-        return {'business_cards': 0, 'flyers': 0, 'b2b_emails': 0}
+COMPARISON_METRICS = [
+    'calls_time', 'call_volume', 'emails_sent', 'emails_received',
+    'business_cards', 'flyers', 'b2b_emails'
+]
 
 @anvil.server.callable
-def calculate_average_rep_stats():
-    """Calculate and store average rep statistics for the current date"""
+def calculate_average_rep_stats(report_date=None):
+    """Store average rep statistics for report_date (default today) from the running totals"""
     try:
-        today = datetime.now().date()
+        today = report_date or datetime.now().date()
         print(f"\n=== Calculating Average Rep Stats for {today} ===")
         
-        # Get all records for today
-        call_stats = app_tables.call_statistics.search(reportDate=today)
-        email_stats = app_tables.outlook_statistics.search(reportDate=today)
-        
-        print("\n--- Call Statistics Input Data ---")
-        call_data = []
-        for row in call_stats:
-            call_data.append({
-                'user': row['userId'],
-                'time': row['totalDuration'],
-                'volume': row['volume']
-            })
-            print(f"User: {row['userId']}")
-            print(f"  - Call Time: {row['totalDuration']} minutes")
-            print(f"  - Call Volume: {row['volume']} calls")
-            
-        print("\n--- Email Statistics Input Data ---")
-        email_data = []
-        for row in email_stats:
-            email_data.append({
-                'user': row['userId'],
-                'sent': row['outbound'],
-                'received': row['inbound']
-            })
-            print(f"User: {row['userId']}")
-            print(f"  - Emails Sent: {row['outbound']}")
-            print(f"  - Emails Received: {row['inbound']}")
-            
-        # Calculate averages
-        stats = {
-            'date': today,
-            'calls_time': 0,
-            'call_volume': 0,
-            'emails_sent': 0,
-            'emails_received': 0,
-            'business_cards': 0,
-            'flyers': 0,
-            'b2b_emails': 0
-        }
-        
-        # Calculate call averages
-        if call_data:
-            stats['calls_time'] = sum(d['time'] for d in call_data) / len(call_data)
-            stats['call_volume'] = sum(d['volume'] for d in call_data) / len(call_data)
-            print(f"\nCall Averages (from {len(call_data)} users):")
-            print(f"  - Average Call Time: {stats['calls_time']:.2f} minutes")
-            print(f"  - Average Call Volume: {stats['call_volume']:.2f} calls")
-        
-        # Calculate email averages
-        if email_data:
-            stats['emails_sent'] = sum(d['sent'] for d in email_data) / len(email_data)
-            stats['emails_received'] = sum(d['received'] for d in email_data) / len(email_data)
-            print(f"\nEmail Averages (from {len(email_data)} users):")
-            print(f"  - Average Emails Sent: {stats['emails_sent']:.2f}")
-            print(f"  - Average Emails Received: {stats['emails_received']:.2f}")
-            
-        # Get B2B averages from Google Sheet
-        print("\n--- Fetching B2B Statistics ---")
-        b2b_stats = get_b2b_stats_for_today()
-        print("B2B Averages:")
-        print(f"  - Average Business Cards: {b2b_stats['business_cards']:.2f}")
-        print(f"  - Average Flyers: {b2b_stats['flyers']:.2f}")
-        print(f"  - Average B2B Emails: {b2b_stats['b2b_emails']:.2f}")
-        stats.update(b2b_stats)
+        # Each metric's average is its running total over the contributing rows
+        totals = get_average_totals(today)
+        stats = {'date': today}
+        for metric in AVERAGE_METRICS:
+            total, users = totals.get(metric, (0, 0))
+            stats[metric] = total / users if users else 0
             
         # Update or create average_rep record
         existing = app_tables.average_rep.get(date=today)
         if existing:
             existing.update(**stats)
-            print("\nUpdated existing average_rep record")
+            print("Updated existing average_rep record")
         else:
             app_tables.average_rep.add_row(**stats)
-            print("\nCreated new average_rep record")
+            print("Created new average_rep record")
             
-        print("\n=== Final Average Statistics ===")
+        print("=== Final Average Statistics ===")
         for key, value in stats.items():
             if key != 'date':
                 print(f"{key}: {value:.2f}")
@@ -274,87 +52,72 @@ def calculate_average_rep_stats():
 
 @anvil.server.background_task
 def calculate_average_rep_stats_scheduled():
-    """Scheduled task to calculate average rep statistics"""
-    print("Starting scheduled average rep calculation")
-    result = calculate_average_rep_stats()
+    """Scheduled task to recalculate average rep statistics for dates changed by ingests"""
+    dates = pop_dirty_dates()
+    if not dates:
+        print("No dirty dates, skipping average rep calculation")
+        return True
+        
+    print(f"Starting scheduled average rep calculation for {len(dates)} dates")
+    result = True
+    for report_date in dates:
+        if not calculate_average_rep_stats(report_date):
+            # Leave the date flagged so the next run retries it
+            mark_dates_dirty([report_date])
+            result = False
     print(f"Scheduled average rep calculation completed: {result}")
     return result
 
+def _summarize_facts(rows, user_email, exclude_date=None):
+    """Sum daily_facts rows into (user totals, average rep) for the Sales metrics.
+    
+    Calls and emails average over the users contributing to them and B2B
+    metrics over submissions. Call and email facts dated exclude_date are
+    skipped, which keeps get_comparison_data's end-exclusive bound for them.
+    """
+    user_id = (user_email or '').lower()
+    user_data = dict.fromkeys(COMPARISON_METRICS, 0)
+    totals = dict.fromkeys(COMPARISON_METRICS, 0)
+    users = {'calls': set(), 'emails': set()}
+    submissions = 0
+    
+    for row in rows:
+        is_user = (row['userId'] or '').lower() == user_id
+        if row['date'] != exclude_date:
+            for source, metrics in (('calls', CALL_TOTALS), ('emails', EMAIL_TOTALS)):
+                # None means the user had no row from that source on this date
+                if all(row[metric] is None for metric in metrics):
+                    continue
+                users[source].add(row['userId'])
+                for metric in metrics:
+                    value = row[metric] or 0
+                    totals[metric] += value
+                    if is_user:
+                        user_data[metric] += value
+        for metric in B2B_TOTALS:
+            value = row[metric] or 0
+            totals[metric] += value
+            if is_user:
+                user_data[metric] += value
+        submissions += row['b2b_submissions'] or 0
+    
+    avg_data = {}
+    for metric in COMPARISON_METRICS:
+        if metric in B2B_TOTALS:
+            divisor = submissions
+        else:
+            divisor = len(users['calls' if metric in CALL_TOTALS else 'emails'])
+        avg_data[metric] = totals[metric] / divisor if divisor else totals[metric]
+    return user_data, avg_data
+
 @anvil.server.callable
 def get_comparison_data(user_email, start_date, end_date):
     """Get comparison data between a specific user and average rep for date range"""
     try:
-        # Get user's data
-        user_data = {
-            'calls_time': 0,
-            'call_volume': 0,
-            'emails_sent': 0,
-            'emails_received': 0,
-            'business_cards': 0,
-            'flyers': 0,
-            'b2b_emails': 0
-        }
-        
-        # Get call data for date range
-        call_rows = app_tables.call_statistics.search(
-            userId=user_email,
-            reportDate=q.between(start_date, end_date)
+        # One pass over the per-user daily facts for the whole range
+        user_data, avg_data = _summarize_facts(
+            get_daily_facts(start_date, end_date), user_email, exclude_date=end_date
         )
-        
-        for row in call_rows:
-            user_data['calls_time'] += row['totalDuration']
-            user_data['call_volume'] += row['volume']
-            
-        # Get email data for date range
-        email_rows = app_tables.outlook_statistics.search(
-            userId=user_email,
-            reportDate=q.between(start_date, end_date)
-        )
-        
-        for row in email_rows:
-            user_data['emails_sent'] += row['outbound']
-            user_data['emails_received'] += row['inbound']
-            
-        # Calculate averages for all users in date range
-        avg_data = {
-            'calls_time': 0,
-            'call_volume': 0,
-            'emails_sent': 0,
-            'emails_received': 0,
-            'business_cards': 0,
-            'flyers': 0,
-            'b2b_emails': 0
-        }
-        
-        # Get all call stats for date range
-        all_calls = app_tables.call_statistics.search(
-            reportDate=q.between(start_date, end_date)
-        )
-        
-        # Get all email stats for date range
-        all_emails = app_tables.outlook_statistics.search(
-            reportDate=q.between(start_date, end_date)
-        )
-        
-        # Calculate averages
-        user_count = len(set(row['userId'] for row in all_calls))
-        if user_count > 0:
-            total_duration = sum(row['totalDuration'] for row in all_calls)
-            total_volume = sum(row['volume'] for row in all_calls)
-            avg_data['calls_time'] = total_duration / user_count
-            avg_data['call_volume'] = total_volume / user_count
-            
-        user_count = len(set(row['userId'] for row in all_emails))
-        if user_count > 0:
-            total_sent = sum(row['outbound'] for row in all_emails)
-            total_received = sum(row['inbound'] for row in all_emails)
-            avg_data['emails_sent'] = total_sent / user_count
-            avg_data['emails_received'] = total_received / user_count
-            
-        # Get B2B stats for date range
-        b2b_stats = get_b2b_stats_for_date_range(start_date, end_date)
-        avg_data.update(b2b_stats)
-            
         return {
             'user': user_data,
             'average': avg_data
@@ -364,6 +127,110 @@ def get_comparison_data(user_email, start_date, end_date):
         print(f"Error getting comparison data: {e}")
         return None
 
+# ===============================================
+# Sales Dashboard
+# ===============================================
+# The Sales page's whole payload - range totals for the user and the average
+# rep plus per-day series for sparklines - is built from one daily_facts read
+# and kept in sales_dashboard_cache. The default window is pre-warmed for
+# every user, so the landing page is served from the table after login.
+DASHBOARD_DAYS = 7
+DASHBOARD_TTL = timedelta(minutes=15)
+# The Sales page picks its window from the browser's date, so "today" for the
+# pre-warmed window is the team's local date rather than the server's UTC one
+DASHBOARD_TIMEZONE = pytz.timezone('America/Chicago')
+
+def _dashboard_payloads(user_emails, start_date, end_date):
+    """Build the dashboard payload for each user from a single range read"""
+    rows = list(get_daily_facts(start_date, end_date))
+    days = [start_date + timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+    rows_by_day = {day: [] for day in days}
+    for row in rows:
+        rows_by_day.setdefault(row['date'], []).append(row)
+    
+    payloads = {}
+    for user_email in user_emails:
+        user_data, avg_data = _summarize_facts(rows, user_email, exclude_date=end_date)
+        series = {
+            'dates': [day.isoformat() for day in days],
+            'user': {metric: [] for metric in COMPARISON_METRICS},
+            'average': {metric: [] for metric in COMPARISON_METRICS}
+        }
+        for day in days:
+            day_user, day_avg = _summarize_facts(rows_by_day[day], user_email)
+            for metric in COMPARISON_METRICS:
+                series['user'][metric].append(day_user[metric])
+                series['average'][metric].append(day_avg[metric])
+        payloads[user_email] = {'user': user_data, 'average': avg_data, 'series': series}
+    return payloads
+
+def _dashboard_row(user_email, start_date, end_date):
+    """Cached row for the window, deleting any duplicates left by concurrent stores"""
+    rows = list(app_tables.sales_dashboard_cache.search(
+        user_email=user_email, start_date=start_date, end_date=end_date
+    ))
+    for extra in rows[1:]:
+        extra.delete()
+    return rows[0] if rows else None
+
+@tables.in_transaction
+def _store_dashboard(user_email, start_date, end_date, payload):
+    row = _dashboard_row(user_email, start_date, end_date)
+    values = {'payload': payload, 'computed_at': datetime.now(timezone.utc)}
+    if row:
+        row.update(**values)
+    else:
+        app_tables.sales_dashboard_cache.add_row(
+            user_email=user_email, start_date=start_date, end_date=end_date, **values
+        )
+
+def _default_window():
+    end_date = datetime.now(DASHBOARD_TIMEZONE).date()
+    return end_date - timedelta(days=DASHBOARD_DAYS), end_date
+
+@anvil.server.callable
+def get_sales_dashboard(user_email, start_date, end_date):
+    """Get the Sales page payload: user and average totals plus per-day series.
+    
+    Returns {'user': {...}, 'average': {...}, 'series': {'dates', 'user', 'average'},
+    'computed_at': datetime}. Totals match get_comparison_data.
+    """
+    try:
+        user_email = (user_email or '').lower()
+        row = _dashboard_row(user_email, start_date, end_date)
+        if row and datetime.now(timezone.utc) - row['computed_at'] < DASHBOARD_TTL:
+            return dict(row['payload'], computed_at=row['computed_at'])
+        
+        payload = _dashboard_payloads([user_email], start_date, end_date)[user_email]
+        # Only the default window is kept; other ranges are cheap to rebuild
+        if (start_date, end_date) == _default_window():
+            _store_dashboard(user_email, start_date, end_date, payload)
+        return dict(payload, computed_at=datetime.now(timezone.utc))
+        
+    except Exception as e:
+        print(f"Error getting sales dashboard: {e}")
+        return None
+
+def warm_sales_dashboards():
+    """Precompute the default dashboard window for every user and drop older windows"""
+    start_date, end_date = _default_window()
+    user_emails = [row['email'].lower() for row in app_tables.users.search() if row['email']]
+    payloads = _dashboard_payloads(user_emails, start_date, end_date)
+    for user_email, payload in payloads.items():
+        _store_dashboard(user_email, start_date, end_date, payload)
+    for row in app_tables.sales_dashboard_cache.search(end_date=q.less_than(end_date)):
+        row.delete()
+    print(f"Warmed sales dashboards for {len(payloads)} users")
+    return len(payloads)
+
+@anvil.server.background_task
+def warm_sales_dashboards_scheduled():
+    """Scheduled task to keep the default Sales dashboard window warm"""
+    try:
+        warm_sales_dashboards()
+    except Exception as e:
+        print(f"Error warming sales dashboards: {e}")
+
 @anvil.server.callable
 def recalculate_todays_averages():
     """Force recalculation of today's averages, called by refresh button"""
@@ -377,8 +244,9 @@ def recalculate_todays_averages():
             print("Removing existing average rep record for today")
             existing.delete()
             
-        # Recalculate averages
-        result = calculate_average_rep_stats()
+        # Rebuild the running totals from source, then recalculate averages
+        rebuild_average_totals(today)
+        result = calculate_average_rep_stats(today)
         print(f"Force recalculation completed: {result}")
         return result
         
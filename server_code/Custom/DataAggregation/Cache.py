@@ -0,0 +1,137 @@
+import anvil.server
+import anvil.tables as tables
+from anvil.tables import app_tables
+import pickle
+from datetime import datetime, timedelta, timezone
+
+# Bounded result cache for report queries.
+#
+# Server modules run in the python3-sandbox, where module state is gone by
+# the next call, so entries live in the result_cache table: one row per
+# cache name and key, holding the pickled value, the cache's generation when
+# it was computed and when it was last used. Each cache keeps at most
+# max_entries rows (least recently used evicted first) and entries expire
+# after ttl seconds. Its generation and hit/miss/eviction counters are kept
+# on its cache_generations row.
+#
+# Writers invalidate a cache by name with invalidate(), which bumps its
+# generation so every entry computed before the write is ignored and dropped.
+
+_caches = {}
+
+def _now():
+    return datetime.now(timezone.utc)
+
+def _first(rows):
+    """First of rows, deleting any duplicates left by concurrent inserts"""
+    rows = list(rows)
+    for extra in rows[1:]:
+        extra.delete()
+    return rows[0] if rows else None
+
+def _state_row(name):
+    """Return the cache_generations row for name, creating it on first use"""
+    row = _first(app_tables.cache_generations.search(name=name))
+    if row is None:
+        row = app_tables.cache_generations.add_row(
+            name=name, generation=0, updated=_now(), hits=0, misses=0, evictions=0
+        )
+    return row
+
+@tables.in_transaction
+def _get_state(name):
+    return _state_row(name)
+
+def _add_count(name, column, n=1):
+    row = _state_row(name)
+    row[column] = (row[column] or 0) + n
+
+@tables.in_transaction
+def _count(name, column, n=1):
+    _add_count(name, column, n)
+
+@tables.in_transaction
+def _bump_generation(name):
+    row = _state_row(name)
+    row.update(generation=(row['generation'] or 0) + 1, updated=_now())
+
+def invalidate(name):
+    """Drop every entry of the named cache"""
+    _bump_generation(name)
+    for row in app_tables.result_cache.search(name=name):
+        row.delete()
+
+@tables.in_transaction
+def _store_entry(name, key, generation, value, max_entries):
+    """Upsert one entry, then evict stale-generation and least recently used rows"""
+    if (_state_row(name)['generation'] or 0) != generation:
+        # Invalidated while the value was computed, so it may already be stale
+        return
+    now = _now()
+    values = {
+        'generation': generation,
+        'value': anvil.BlobMedia('application/octet-stream', pickle.dumps(value), name=f"{name}.pickle"),
+        'computed_at': now,
+        'used_at': now
+    }
+    row = _first(app_tables.result_cache.search(name=name, key=key))
+    if row:
+        row.update(**values)
+    else:
+        app_tables.result_cache.add_row(name=name, key=key, **values)
+
+    evicted = 0
+    rows = app_tables.result_cache.search(tables.order_by('used_at', ascending=False), name=name)
+    for n, row in enumerate(rows):
+        if n >= max_entries or row['generation'] != generation:
+            row.delete()
+            evicted += 1
+    if evicted:
+        _add_count(name, 'evictions', evicted)
+
+class ResultCache:
+    """Table-backed LRU cache with a TTL, a size bound and hit/miss counters"""
+
+    def __init__(self, name, max_entries=64, ttl=300):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        _caches[name] = self
+
+    def get(self, key, compute):
+        """Return the cached value for key, calling compute() and storing it on a miss.
+
+        key must have a stable repr(), such as a tuple of dates and strings.
+        """
+        key = repr(key)
+        generation = _get_state(self.name)['generation'] or 0
+        row = _first(app_tables.result_cache.search(name=self.name, key=key))
+        if (row and row['generation'] == generation
+                and _now() - row['computed_at'] < timedelta(seconds=self.ttl)):
+            row['used_at'] = _now()
+            _count(self.name, 'hits')
+            return pickle.loads(row['value'].get_bytes())
+
+        _count(self.name, 'misses')
+        value = compute()
+        _store_entry(self.name, key, generation, value, self.max_entries)
+        return value
+
+    def stats(self):
+        state = _get_state(self.name)
+        hits, misses = state['hits'] or 0, state['misses'] or 0
+        lookups = hits + misses
+        return {
+            'entries': len(app_tables.result_cache.search(name=self.name)),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': hits,
+            'misses': misses,
+            'evictions': state['evictions'] or 0,
+            'hit_rate': hits / lookups if lookups else 0
+        }
+
+@anvil.server.callable
+def get_cache_stats():
+    """Hit/miss counters for every report cache"""
+    return {name: cache.stats() for name, cache in _caches.items()}
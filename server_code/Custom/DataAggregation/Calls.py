@@ -1,53 +1,137 @@
 import anvil.server
-import anvil.tables as tables
-from anvil.tables import app_tables
-import anvil.tables.query as q
-from datetime import datetime
+from .Cache import ResultCache
+from .Rollups import CALL_ROLLUP_COLUMNS, ROLLUP_TIERS, pick_tier, period_start, read_stat_periods
 
-# Add cache for call data
-_call_data_cache = {}
-CACHE_DURATION = 300  # 5 minutes in seconds
+# Metric columns a call data response can carry, in display order
+CALL_METRICS = [
+    "inboundVolume", "inboundDuration", "outboundVolume", "outboundDuration",
+    "averageDuration", "volume", "totalDuration", "inboundQueueVolume"
+]
+DURATION_METRICS = [metric for metric in CALL_METRICS if 'Duration' in metric]
+
+# Bounded, write-invalidated cache of columnar call data per date range
+call_data_cache = ResultCache('call_data', max_entries=64, ttl=300)
+
+def _empty_call_data(metrics):
+    return {"userId": [], "userName": [], "reportDate": [], "metrics": {m: [] for m in metrics}}
 
 @anvil.server.callable
-def get_call_data(queryStart, queryEnd):
-    """Get call data with caching and optimized querying."""
+def get_call_data(queryStart, queryEnd, metrics=None):
+    """Get call data as parallel arrays, limited to the requested metrics.
+    
+    Durations are returned in whole minutes. The response is
+    {"userId": [...], "userName": [...], "reportDate": [...], "metrics": {metric: [...]}}.
+    """
+    metrics = [m for m in (metrics or CALL_METRICS) if m in CALL_METRICS]
     try:
-        cache_key = f"{queryStart}_{queryEnd}"
-        current_time = datetime.now().timestamp()
-        
-        # Check cache first
-        if cache_key in _call_data_cache:
-            cached_data, timestamp = _call_data_cache[cache_key]
-            if current_time - timestamp < CACHE_DURATION:
-                return cached_data
-
-        # Optimize query with specific column selection and indexing
-        queryData = list(app_tables.call_statistics.search(
-            tables.order_by('reportDate', ascending=True),
-            reportDate=q.between(queryStart, queryEnd, min_inclusive=True, max_inclusive=True)
-        ))
-
-        # Early return for empty data
-        if not queryData:
-            return {"columns": [], "values": []}
-
-        # Get column names once
-        column_metadata = app_tables.call_statistics.list_columns()
-        column_names = [col['name'] for col in column_metadata]
-
-        # Batch process rows efficiently
-        user_values = []
-        for row in queryData:
-            user_values.append([row[col] for col in column_names])
-
-        result = {"columns": column_names, "values": user_values}
-        
-        # Cache the results
-        _call_data_cache[cache_key] = (result, current_time)
-        
-        print(f"Call data fetched successfully: {len(user_values)} rows")
-        return result
+        # Long ranges are bucketed by week or month, read from the rollups
+        tier = pick_tier(queryStart, queryEnd)
+        data = call_data_cache.get(
+            (queryStart, queryEnd, tier), lambda: _load_call_data(queryStart, queryEnd, tier)
+        )
+        return _project(data, metrics)
 
     except Exception as e:
         print(f"Error in get_call_data: {e}")
-        return {"columns": [], "values": []}
+        return _empty_call_data(metrics)
+
+def _project(data, metrics):
+    return dict(data, metrics={metric: data["metrics"][metric] for metric in metrics})
+
+def _load_call_data(queryStart, queryEnd, tier):
+    """Read call statistics for the inclusive range into columns, one row per user and tier bucket"""
+    tiers = ROLLUP_TIERS[ROLLUP_TIERS.index(tier):] if tier in ROLLUP_TIERS else []
+    
+    buckets = {}
+    for period, row in read_stat_periods('call_statistics', queryStart, queryEnd, tiers):
+        bucket_date = max(period_start(tier, period), queryStart)
+        bucket = buckets.get((row['userId'], bucket_date))
+        if bucket is None:
+            bucket = {metric: row[metric] for metric in CALL_METRICS}
+            bucket.update(userId=row['userId'], userName=row['userName'], reportDate=bucket_date)
+            buckets[(row['userId'], bucket_date)] = bucket
+        else:
+            for col in CALL_ROLLUP_COLUMNS:
+                bucket[col] = (bucket[col] or 0) + (row[col] or 0)
+
+    result = _empty_call_data(CALL_METRICS)
+    for bucket in sorted(buckets.values(), key=lambda b: b['reportDate']):
+        if tier != 'day':
+            bucket['averageDuration'] = (
+                bucket['totalDuration'] // bucket['volume'] if bucket['volume'] else 0
+            )
+        for col in ("userId", "userName", "reportDate"):
+            result[col].append(bucket[col])
+        for metric in CALL_METRICS:
+            value = bucket[metric]
+            # Durations are stored in milliseconds and shown in minutes
+            if metric in DURATION_METRICS and value is not None:
+                value = int(value // 60000)
+            result["metrics"][metric].append(value)
+
+    print(f"Call data fetched successfully: {len(buckets)} {tier} rows")
+    return result
+
+@anvil.server.callable
+def get_call_days(days, metrics=None):
+    """Get daily call data, in the get_call_data format, for just the listed dates.
+    
+    Lets the client fetch only the days missing from its own per-day cache.
+    Errors are raised rather than returned as empty data, so the client
+    never caches days it didn't actually receive.
+    """
+    metrics = [m for m in (metrics or CALL_METRICS) if m in CALL_METRICS]
+    result = _empty_call_data(metrics)
+    days = sorted(set(days))
+    if not days:
+        return result
+
+    # Read each run of consecutive days as one range
+    runs = [[days[0], days[0]]]
+    for day in days[1:]:
+        if (day - runs[-1][1]).days == 1:
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+
+    try:
+        for start, end in runs:
+            data = _project(_load_call_data(start, end, 'day'), metrics)
+            for col in ("userId", "userName", "reportDate"):
+                result[col].extend(data[col])
+            for metric in metrics:
+                result["metrics"][metric].extend(data["metrics"][metric])
+        print(f"Call data fetched for {len(days)} days in {len(runs)} ranges")
+        return result
+
+    except Exception as e:
+        print(f"Error in get_call_days: {e}")
+        raise
+
+@anvil.server.callable
+def get_call_traces(queryStart, queryEnd, metrics=None):
+    """Get ready-to-plot call series and totals per user for the requested metrics.
+    
+    Returns {"metrics": [...], "users": [{"userId", "userName", "x", "y": {metric: [...]},
+    "totals": {metric: n}}]}, with x as YYYY-MM-DD strings.
+    """
+    data = get_call_data(queryStart, queryEnd, metrics)
+    metric_values = data["metrics"]
+    users = {}
+    for i, user_id in enumerate(data["userId"]):
+        user = users.get(user_id)
+        if user is None:
+            user = users[user_id] = {
+                "userId": user_id,
+                "userName": data["userName"][i],
+                "x": [],
+                "y": {metric: [] for metric in metric_values},
+                "totals": {metric: 0 for metric in metric_values}
+            }
+        user["x"].append(data["reportDate"][i].strftime('%Y-%m-%d'))
+        for metric, values in metric_values.items():
+            user["y"][metric].append(values[i])
+            if isinstance(values[i], (int, float)):
+                user["totals"][metric] += values[i]
+
+    return {"metrics": list(metric_values), "users": list(users.values())}
@@ -1,19 +1,39 @@
 import anvil.secrets
 import anvil.users
 import anvil.tables as tables
-import anvil.tables.query as q
 from anvil.tables import app_tables
 import anvil.server
 from datetime import datetime, timedelta
 import pytz
+from .Cache import ResultCache
+from .Rollups import (
+    EMAIL_TOTALS, apply_average_deltas, apply_rollup_deltas, column_deltas, merge_deltas,
+    read_stat_periods, row_deltas, upsert_daily_facts
+)
 
 # Add cache dictionary
 _stats_cache = {}
 CACHE_DURATION = 300  # 5 minutes in seconds
 
+# Email -> display name map for the report charts. The cache is table-backed,
+# so one users search serves every call until the TTL runs out.
+display_name_cache = ResultCache('display_names', max_entries=1, ttl=600)
+
+def _load_display_names():
+    return {
+        row['email'].lower(): row['name']
+        for row in app_tables.users.search()
+        if row['email'] and row['name']
+    }
+
+def get_display_names(emails):
+    """Map each email to its user's display name, falling back to the email itself"""
+    names = display_name_cache.get('users', _load_display_names)
+    return {email: names.get(email.lower(), email) for email in emails}
+
 @anvil.server.callable
-def update_outlook_statistics_db(results):
-    """Update the database with email statistics"""
+def update_outlook_statistics_db(results, report_date=None):
+    """Update the database with email statistics for report_date (default today)"""
     try:
         print("\n=== Starting Database Update ===")
         print(f"Received results: {results}")
@@ -22,42 +42,8 @@ def update_outlook_statistics_db(results):
             print("No results to update")
             return False
             
-        today = datetime.now().date()
-        updated = 0
-        
-        for result in results:
-            try:
-                if not isinstance(result, dict) or 'user' not in result:
-                    continue
-                    
-                email = result['user'].lower()  # Ensure email is lowercase
-                print(f"\nProcessing result for: {email}")
-                
-                # Check for existing record
-                existing = app_tables.outlook_statistics.get(
-                    userId=email,
-                    reportDate=today
-                )
-                
-                stats = {
-                    'userId': email,
-                    'userName': email.split('@')[0],
-                    'reportDate': today,
-                    'inbound': int(result.get('inbox_count', 0)),
-                    'outbound': int(result.get('sent_count', 0)),
-                    'total': int(result.get('inbox_count', 0)) + int(result.get('sent_count', 0))
-                }
-                
-                if existing:
-                    existing.update(**stats)
-                else:
-                    app_tables.outlook_statistics.add_row(**stats)
-                updated += 1
-                    
-            except Exception as row_error:
-                print(f"Error processing row: {str(row_error)}")
-                continue
-                
+        report_date = report_date or datetime.now().date()
+        updated = _write_outlook_statistics(results, report_date)
         print(f"\nUpdated {updated} of {len(results)} records")
         return updated > 0
         
@@ -65,18 +51,74 @@ def update_outlook_statistics_db(results):
         print(f"Database update error: {str(e)}")
         return False
 
+@tables.in_transaction
+def _write_outlook_statistics(results, report_date):
+    """Upsert one day's rows and apply their deltas to the derived tables in one transaction"""
+    updated = 0
+    deltas = {}
+    facts = {}
+    period_deltas = {}
+    user_names = {}
+    
+    # Load the day's existing records once
+    existing_rows = {
+        row['userId']: row
+        for row in app_tables.outlook_statistics.search(reportDate=report_date)
+    }
+    
+    for result in results:
+        try:
+            if not isinstance(result, dict) or 'user' not in result:
+                continue
+                
+            email = result['user'].lower()  # Ensure email is lowercase
+            print(f"\nProcessing result for: {email}")
+            
+            # Check for existing record
+            existing = existing_rows.get(email)
+            
+            stats = {
+                'userId': email,
+                'userName': email.split('@')[0],
+                'reportDate': report_date,
+                'inbound': int(result.get('inbox_count', 0)),
+                'outbound': int(result.get('sent_count', 0)),
+                'total': int(result.get('inbox_count', 0)) + int(result.get('sent_count', 0))
+            }
+            
+            merge_deltas(deltas, row_deltas(EMAIL_TOTALS, existing, stats))
+            facts[email] = {'emails_sent': stats['outbound'], 'emails_received': stats['inbound']}
+            period_deltas[email] = column_deltas('outlook_statistics', existing, stats)
+            user_names[email] = stats['userName']
+            if existing:
+                existing.update(**stats)
+            else:
+                existing_rows[email] = app_tables.outlook_statistics.add_row(**stats)
+            updated += 1
+                
+        except Exception as row_error:
+            print(f"Error processing row: {str(row_error)}")
+            continue
+            
+    if updated:
+        apply_average_deltas(report_date, deltas)
+        upsert_daily_facts(report_date, facts)
+        apply_rollup_deltas('outlook_statistics', report_date, period_deltas, user_names)
+    return updated
+
 @anvil.server.callable
 def get_email_stats(start_date, end_date):
     """Get email statistics for the given date range"""
     try:
         print(f"Fetching email stats from {start_date} to {end_date}")  # Debug log
         
-        # Get data using correct column names
-        rows = app_tables.outlook_statistics.search(
-            tables.order_by("userId"),
-            reportDate=q.between(start_date, end_date)
-        )
-        rows_list = list(rows)  # Convert to list for length check
+        # Whole weeks and months come from the rollups, the edges from daily rows.
+        # The end date stays exclusive, as it always has been for this report.
+        rows_list = [
+            row for _, row in read_stat_periods(
+                'outlook_statistics', start_date, end_date - timedelta(days=1)
+            )
+        ]
         print(f"Found {len(rows_list)} records")  # Debug log
         
         users = set()
@@ -95,10 +137,11 @@ def get_email_stats(start_date, end_date):
         
         return {
             "users": sorted(list(users)) or ["No Data"],
-            "metrics": metrics
+            "metrics": metrics,
+            "display_names": get_display_names(users)
         }
         
     except Exception as e:
         print(f"Error in get_email_stats: {str(e)}")
         print(f"Full error details: {repr(e)}")
-        return {"users": ["No Data"], "metrics": {'total': {}, 'inbound': {}, 'outbound': {}}}
+        return {"users": ["No Data"], "metrics": {'total': {}, 'inbound': {}, 'outbound': {}}, "display_names": {}}
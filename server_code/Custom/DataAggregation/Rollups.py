@@ -0,0 +1,546 @@
+import anvil.server
+import anvil.tables as tables
+import anvil.tables.query as q
+from anvil.tables import app_tables
+from datetime import datetime, timedelta, timezone
+from .Cache import invalidate
+
+# Pre-aggregated tables that report queries read instead of raw data.
+
+B2B_DAILY_COLUMNS = ['business_cards', 'flyers', 'emails', 'submissions']
+
+def _as_naive(timestamp):
+    """Drop tz info from stored datetimes so they compare with sheet timestamps"""
+    if timestamp.tzinfo is not None:
+        return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+# ===============================================
+# Seeding State
+# ===============================================
+# Ingests keep the derived tables current with deltas, which says nothing
+# about history from before a table existed. seed_rollups_scheduled builds
+# each table once from its source and records it in rollup_seeding; until
+# then the table's readers compute from the source tables instead.
+def is_seeded(name):
+    """Whether the named derived table has been built from its source"""
+    return app_tables.rollup_seeding.get(name=name) is not None
+
+def mark_seeded(name):
+    if not is_seeded(name):
+        app_tables.rollup_seeding.add_row(name=name, seeded_at=datetime.now())
+
+def _date_range(table_name, column='reportDate'):
+    """First and last date in a table's date column, or (None, None) if it is empty"""
+    table = getattr(app_tables, table_name)
+    first = next(iter(table.search(tables.order_by(column, ascending=True))), None)
+    last = next(iter(table.search(tables.order_by(column, ascending=False))), None)
+    return (first[column], last[column]) if first else (None, None)
+
+# ===============================================
+# Dirty Dates for Average Rep
+# ===============================================
+def mark_dates_dirty(dates):
+    """Flag dates whose average_rep row needs recomputing after an ingest write"""
+    for date in set(dates):
+        if not app_tables.average_rep_dirty.get(date=date):
+            app_tables.average_rep_dirty.add_row(date=date, marked_at=datetime.now())
+
+def pop_dirty_dates():
+    """Return and clear the pending dirty dates, oldest first"""
+    rows = list(app_tables.average_rep_dirty.search(tables.order_by('date')))
+    dates = [row['date'] for row in rows]
+    # Clear before recomputing so writes made meanwhile mark the date again
+    for row in rows:
+        row.delete()
+    return dates
+
+# ===============================================
+# Running Totals for Average Rep
+# ===============================================
+# average_rep_totals holds, per day and metric, the sum over all users and
+# the number of rows contributing to it. Ingest upserts apply deltas, so an
+# average is total / users without rescanning the day's rows. For the B2B
+# metrics the count is submissions, matching the per-submission average the
+# B2B readers have always reported.
+#
+# A delta is only correct against the source row it was computed from, so
+# ingests read their source rows, write them and apply the deltas in one
+# transaction; apply_average_deltas must be called inside it.
+AVERAGE_METRICS = [
+    'calls_time', 'call_volume', 'emails_sent', 'emails_received',
+    'business_cards', 'flyers', 'b2b_emails'
+]
+CALL_TOTALS = {'calls_time': 'totalDuration', 'call_volume': 'volume'}
+EMAIL_TOTALS = {'emails_sent': 'outbound', 'emails_received': 'inbound'}
+B2B_TOTALS = {'business_cards': 'business_cards', 'flyers': 'flyers', 'b2b_emails': 'emails'}
+
+def row_deltas(columns, old, new):
+    """Totals deltas for one user's row changing from old (None if new) to new values"""
+    return {
+        metric: ((new[col] or 0) - ((old[col] or 0) if old else 0), 0 if old else 1)
+        for metric, col in columns.items()
+    }
+
+def merge_deltas(into, deltas):
+    """Accumulate {metric: (total, users)} deltas into another delta dict"""
+    for metric, (total, users) in deltas.items():
+        current = into.get(metric, (0, 0))
+        into[metric] = (current[0] + total, current[1] + users)
+    return into
+
+def apply_average_deltas(date, deltas, mark_dirty=True):
+    """Apply {metric: (total, users)} deltas to a day's running totals and flag it dirty.
+    
+    Call inside the transaction that wrote the source rows the deltas came from.
+    Rebuilds pass mark_dirty=False, as they leave the day's totals as they were.
+    """
+    changes = {metric: delta for metric, delta in deltas.items() if delta[0] or delta[1]}
+    if not changes:
+        # Rewriting identical rows leaves the day's averages as they are
+        return
+    rows = {row['metric']: row for row in app_tables.average_rep_totals.search(date=date)}
+    for metric, (total, users) in changes.items():
+        row = rows.get(metric)
+        if row:
+            row.update(total=(row['total'] or 0) + total, users=(row['users'] or 0) + users)
+        else:
+            app_tables.average_rep_totals.add_row(date=date, metric=metric, total=total, users=users)
+    if mark_dirty:
+        mark_dates_dirty([date])
+
+def _average_totals_from_source(date):
+    """Compute a day's {metric: (total, users)} from the underlying tables"""
+    deltas = {}
+    for row in app_tables.call_statistics.search(reportDate=date):
+        merge_deltas(deltas, row_deltas(CALL_TOTALS, None, row))
+    for row in app_tables.outlook_statistics.search(reportDate=date):
+        merge_deltas(deltas, row_deltas(EMAIL_TOTALS, None, row))
+    for row in get_b2b_daily(date, date):
+        merge_deltas(deltas, {
+            metric: (row[col] or 0, row['submissions'] or 0) for metric, col in B2B_TOTALS.items()
+        })
+    return deltas
+
+def get_average_totals(date):
+    """Return {metric: (total, users)} for a day"""
+    if not is_seeded('average_rep_totals'):
+        return _average_totals_from_source(date)
+    return {
+        row['metric']: (row['total'] or 0, row['users'] or 0)
+        for row in app_tables.average_rep_totals.search(date=date)
+    }
+
+@tables.in_transaction
+def rebuild_average_totals(date):
+    """Recompute a day's running totals from the underlying tables"""
+    deltas = _average_totals_from_source(date)
+    for row in app_tables.average_rep_totals.search(date=date):
+        row.delete()
+    apply_average_deltas(date, deltas, mark_dirty=False)
+    print(f"Rebuilt average totals for {date}")
+    return deltas
+
+# ===============================================
+# Per-user Daily Facts
+# ===============================================
+# daily_facts has one row per (userId, date) with every Sales metric, so the
+# comparison view is a single range read. Call and email columns are set by
+# their ingests (None when the user has no row for that source); the B2B
+# columns are counted up by the sheet import, keyed by lowercased sales rep.
+B2B_FACT_COLUMNS = ['business_cards', 'flyers', 'b2b_emails', 'b2b_submissions']
+FACT_COLUMNS = ['calls_time', 'call_volume', 'emails_sent', 'emails_received'] + B2B_FACT_COLUMNS
+
+def upsert_daily_facts(date, values_by_user, increment=False):
+    """Set, or with increment=True add to, fact columns for each user on date"""
+    if not values_by_user:
+        return
+    existing = {row['userId']: row for row in app_tables.daily_facts.search(date=date)}
+    new_rows = []
+    with tables.batch_update:
+        for user_id, values in values_by_user.items():
+            row = existing.get(user_id)
+            if increment and row:
+                values = {col: (row[col] or 0) + value for col, value in values.items()}
+            if row:
+                row.update(**values)
+            else:
+                new_rows.append(dict(values, userId=user_id, date=date))
+    if new_rows:
+        app_tables.daily_facts.add_rows(new_rows)
+
+def _daily_facts_from_source(start_date, end_date):
+    """Compute {(userId, date): fact values} for the inclusive range from the underlying tables"""
+    facts = {}
+    def fact(user_id, date):
+        return facts.setdefault((user_id, date), {})
+
+    between = q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+    for row in app_tables.call_statistics.search(reportDate=between):
+        fact(row['userId'], row['reportDate']).update(
+            calls_time=row['totalDuration'], call_volume=row['volume'])
+    for row in app_tables.outlook_statistics.search(reportDate=between):
+        fact(row['userId'], row['reportDate']).update(
+            emails_sent=row['outbound'], emails_received=row['inbound'])
+    for row in get_b2b_daily(start_date, end_date):
+        values = fact((row['sales_rep'] or '').lower(), row['date'])
+        for metric, col in dict(B2B_TOTALS, b2b_submissions='submissions').items():
+            values[metric] = values.get(metric, 0) + (row[col] or 0)
+    return facts
+
+def get_daily_facts(start_date, end_date):
+    """Return the daily_facts rows for the inclusive date range"""
+    if not is_seeded('daily_facts'):
+        return [
+            dict(dict.fromkeys(FACT_COLUMNS), **values, userId=user_id, date=date)
+            for (user_id, date), values in _daily_facts_from_source(start_date, end_date).items()
+        ]
+    return app_tables.daily_facts.search(
+        date=q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+    )
+
+@tables.in_transaction
+def _rebuild_daily_facts_range(start_date, end_date):
+    facts = _daily_facts_from_source(start_date, end_date)
+    for row in app_tables.daily_facts.search(
+        date=q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+    ):
+        row.delete()
+    if facts:
+        app_tables.daily_facts.add_rows([
+            dict(values, userId=user_id, date=date) for (user_id, date), values in facts.items()
+        ])
+    return len(facts)
+
+def rebuild_daily_facts(start_date, end_date):
+    """Recompute daily_facts for a date range from the underlying tables, a month per transaction"""
+    rebuilt = 0
+    start = start_date
+    while start <= end_date:
+        end = min(end_date, _next_period('month', period_start('month', start)) - timedelta(days=1))
+        rebuilt += _rebuild_daily_facts_range(start, end)
+        start = end + timedelta(days=1)
+    print(f"Rebuilt {rebuilt} daily facts from {start_date} to {end_date}")
+    return rebuilt
+
+# ===============================================
+# Weekly and Monthly Statistics Rollups
+# ===============================================
+# call_statistics_rollup and outlook_statistics_rollup hold per-user sums of
+# the daily rows for each week (Monday start) and calendar month, keyed by
+# tier and periodStart. Ingests apply the changed rows' deltas, and range
+# reads take whole periods from the coarsest tier with daily rows at the edges.
+ROLLUP_TIERS = ['month', 'week']
+CALL_ROLLUP_COLUMNS = [
+    "inboundVolume", "inboundDuration", "outboundVolume", "outboundDuration",
+    "volume", "totalDuration", "inboundQueueVolume"
+]
+STAT_ROLLUPS = {
+    'call_statistics': ('call_statistics_rollup', CALL_ROLLUP_COLUMNS),
+    'outlook_statistics': ('outlook_statistics_rollup', ['inbound', 'outbound', 'total'])
+}
+
+def period_start(tier, day):
+    """First day of the week or month containing day (day itself for 'day')"""
+    if tier == 'week':
+        return day - timedelta(days=day.weekday())
+    if tier == 'month':
+        return day.replace(day=1)
+    return day
+
+def _next_period(tier, start):
+    """First day of the period after the one starting on start"""
+    if tier == 'week':
+        return start + timedelta(days=7)
+    if tier == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=1)
+
+def pick_tier(start_date, end_date):
+    """Coarsest tier a time series over the inclusive range should be plotted at"""
+    days = (end_date - start_date).days + 1
+    if days > 120:
+        return 'month'
+    if days > 31:
+        return 'week'
+    return 'day'
+
+def _cover(start_date, end_date, tiers):
+    """Split a date range into (tier, first, last) segments of whole periods, coarsest first"""
+    if start_date > end_date:
+        return []
+    if not tiers:
+        return [('day', start_date, end_date)]
+    tier, finer = tiers[0], tiers[1:]
+    first = period_start(tier, start_date)
+    if first < start_date:
+        first = _next_period(tier, first)
+    # Start of the period after the last one that ends inside the range
+    after = period_start(tier, end_date + timedelta(days=1))
+    if first >= after:
+        return _cover(start_date, end_date, finer)
+    return (
+        _cover(start_date, first - timedelta(days=1), finer)
+        + [(tier, first, after - timedelta(days=1))]
+        + _cover(after, end_date, finer)
+    )
+
+def read_stat_periods(source, start_date, end_date, tiers=ROLLUP_TIERS):
+    """Yield (period start, row) covering the inclusive range with as few rows as the tiers allow"""
+    rollup_table = getattr(app_tables, STAT_ROLLUPS[source][0])
+    if not is_seeded(STAT_ROLLUPS[source][0]):
+        # Until the rollup covers the full history, read every day
+        tiers = []
+    for tier, first, last in _cover(start_date, end_date, list(tiers)):
+        between = q.between(first, last, min_inclusive=True, max_inclusive=True)
+        if tier == 'day':
+            for row in getattr(app_tables, source).search(reportDate=between):
+                yield row['reportDate'], row
+        else:
+            for row in rollup_table.search(tier=tier, periodStart=between):
+                yield row['periodStart'], row
+
+def _with_average_duration(values):
+    """Derive a call rollup's averageDuration, which cannot be summed"""
+    if 'totalDuration' in values:
+        volume = values.get('volume') or 0
+        values['averageDuration'] = values['totalDuration'] // volume if volume else 0
+    return values
+
+def column_deltas(source, old, new):
+    """Per-column deltas for one user's daily row changing from old (None if new) to new"""
+    return {
+        col: (new[col] or 0) - ((old[col] or 0) if old else 0)
+        for col in STAT_ROLLUPS[source][1]
+    }
+
+def apply_rollup_deltas(source, report_date, user_deltas, user_names=None):
+    """Add {userId: {column: delta}} for report_date into its week and month rollup rows"""
+    if not user_deltas:
+        return
+    table_name, columns = STAT_ROLLUPS[source]
+    table = getattr(app_tables, table_name)
+    user_names = user_names or {}
+    for tier in ROLLUP_TIERS:
+        start = period_start(tier, report_date)
+        existing = {row['userId']: row for row in table.search(tier=tier, periodStart=start)}
+        new_rows = []
+        with tables.batch_update:
+            for user_id, deltas in user_deltas.items():
+                row = existing.get(user_id)
+                values = _with_average_duration({
+                    col: ((row[col] if row else 0) or 0) + deltas.get(col, 0) for col in columns
+                })
+                if user_id in user_names:
+                    values['userName'] = user_names[user_id]
+                if row:
+                    row.update(**values)
+                else:
+                    new_rows.append(dict(values, tier=tier, periodStart=start, userId=user_id))
+        if new_rows:
+            table.add_rows(new_rows)
+
+
+@tables.in_transaction
+def _rebuild_stat_period(source, tier, start):
+    """Replace one week or month's rollup rows with sums of its daily rows"""
+    table_name, columns = STAT_ROLLUPS[source]
+    table = getattr(app_tables, table_name)
+    end = _next_period(tier, start) - timedelta(days=1)
+    sums = {}
+    for row in getattr(app_tables, source).search(
+        reportDate=q.between(start, end, min_inclusive=True, max_inclusive=True)
+    ):
+        values = sums.setdefault(row['userId'], dict.fromkeys(columns, 0))
+        values['userName'] = row['userName']
+        for col in columns:
+            values[col] += row[col] or 0
+
+    for row in table.search(tier=tier, periodStart=start):
+        row.delete()
+    if sums:
+        table.add_rows([
+            dict(_with_average_duration(values), tier=tier, periodStart=start, userId=user_id)
+            for user_id, values in sums.items()
+        ])
+    return len(sums)
+
+def rebuild_stat_rollups(source, start_date=None, end_date=None):
+    """Recompute the week and month rollups overlapping a date range (default: all data).
+    
+    Each period is rebuilt from its daily rows in its own transaction, so
+    ingests writing meanwhile are never lost or counted twice.
+    """
+    if start_date is None or end_date is None:
+        first, last = _date_range(source)
+        if first is None:
+            return 0
+        start_date, end_date = start_date or first, end_date or last
+
+    rebuilt = 0
+    for tier in ROLLUP_TIERS:
+        start = period_start(tier, start_date)
+        while start <= end_date:
+            rebuilt += _rebuild_stat_period(source, tier, start)
+            start = _next_period(tier, start)
+    if source == 'call_statistics':
+        invalidate('call_data')
+    print(f"Rebuilt {rebuilt} {STAT_ROLLUPS[source][0]} rows from {start_date} to {end_date}")
+    return rebuilt
+
+# ===============================================
+# B2B Daily Rollup
+# ===============================================
+def _count_b2b_rows(b2b_rows):
+    """Per (date, sales_rep) counts of b2b rows for the b2b_daily columns"""
+    deltas = {}
+    for row in b2b_rows:
+        key = (_as_naive(row['timestamp']).date(), row['sales_rep'])
+        counts = deltas.setdefault(key, dict.fromkeys(B2B_DAILY_COLUMNS, 0))
+        counts['business_cards'] += 1 if row['business_cards'] else 0
+        counts['flyers'] += 1 if row['flyers'] else 0
+        counts['emails'] += 1 if row['email'] else 0
+        counts['submissions'] += 1
+    return deltas
+
+def apply_b2b_daily(b2b_rows):
+    """Add newly imported b2b rows to the per-rep per-day counts.
+    
+    Call inside the transaction that inserted the rows.
+    """
+    deltas = _count_b2b_rows(b2b_rows)
+    if not deltas:
+        return 0
+
+    # Load the affected days once instead of one get() per rep/day
+    dates = [date for date, _ in deltas]
+    existing = {
+        (row['date'], row['sales_rep']): row
+        for row in app_tables.b2b_daily.search(date=q.between(min(dates), max(dates), max_inclusive=True))
+    }
+
+    new_rows = []
+    average_deltas = {}
+    for (date, sales_rep), counts in deltas.items():
+        row = existing.get((date, sales_rep))
+        if row:
+            row.update(**{col: (row[col] or 0) + counts[col] for col in B2B_DAILY_COLUMNS})
+        else:
+            new_rows.append(dict(counts, date=date, sales_rep=sales_rep))
+        merge_deltas(average_deltas.setdefault(date, {}), {
+            metric: (counts[col], counts['submissions']) for metric, col in B2B_TOTALS.items()
+        })
+    if new_rows:
+        app_tables.b2b_daily.add_rows(new_rows)
+
+    for date, date_deltas in average_deltas.items():
+        apply_average_deltas(date, date_deltas)
+
+    facts = {}
+    for (date, sales_rep), counts in deltas.items():
+        values = facts.setdefault(date, {}).setdefault(sales_rep.lower(), dict.fromkeys(B2B_FACT_COLUMNS, 0))
+        values['business_cards'] += counts['business_cards']
+        values['flyers'] += counts['flyers']
+        values['b2b_emails'] += counts['emails']
+        values['b2b_submissions'] += counts['submissions']
+    for date, values_by_user in facts.items():
+        upsert_daily_facts(date, values_by_user, increment=True)
+    print(f"Applied B2B rollup for {len(deltas)} rep/days")
+    return len(deltas)
+
+def get_b2b_daily(start_date, end_date):
+    """Return the b2b_daily rows for the inclusive date range"""
+    if not is_seeded('b2b_daily'):
+        # Count the raw submissions until the rollup holds the full history
+        return [
+            dict(counts, date=date, sales_rep=sales_rep)
+            for (date, sales_rep), counts in _count_b2b_rows(b2b_rows_between(start_date, end_date)).items()
+        ]
+    return app_tables.b2b_daily.search(
+        date=q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+    )
+
+def b2b_rows_between(start_date, end_date):
+    """The b2b rows dated within the inclusive range"""
+    # Stored timestamps may come back tz-aware, so search a day either side
+    # and compare dates the way the rollup computes them
+    rows = app_tables.b2b.search(timestamp=q.between(
+        datetime.combine(start_date - timedelta(days=1), datetime.min.time()),
+        datetime.combine(end_date + timedelta(days=2), datetime.min.time())
+    ))
+    return [row for row in rows if start_date <= _as_naive(row['timestamp']).date() <= end_date]
+
+def rebuild_b2b_daily_range(start_date, end_date):
+    """Replace b2b_daily for the inclusive range with counts of its b2b rows.
+    
+    Call inside a transaction. The B2B facts and running totals are left
+    alone; seeding rebuilds them from b2b_daily afterwards.
+    """
+    for row in app_tables.b2b_daily.search(
+        date=q.between(start_date, end_date, min_inclusive=True, max_inclusive=True)
+    ):
+        row.delete()
+    counts = _count_b2b_rows(b2b_rows_between(start_date, end_date))
+    if counts:
+        app_tables.b2b_daily.add_rows([
+            dict(values, date=date, sales_rep=sales_rep) for (date, sales_rep), values in counts.items()
+        ])
+    return len(counts)
+
+# ===============================================
+# Seeding
+# ===============================================
+def _source_date_range():
+    """First and last date across the call, email and B2B daily tables"""
+    ranges = [
+        _date_range('call_statistics'), _date_range('outlook_statistics'),
+        _date_range('b2b_daily', 'date')
+    ]
+    firsts = [first for first, _ in ranges if first]
+    if not firsts:
+        return None, None
+    return min(firsts), max(last for _, last in ranges if last)
+
+def _seed_b2b_daily():
+    # The sheet import owns the b2b table and imports this module, so import it here
+    from ..APICalls.SheetsB2B import reimport_sheet_history
+    reimport_sheet_history()
+
+def _seed_average_totals():
+    day, last = _source_date_range()
+    while day and day <= last:
+        rebuild_average_totals(day)
+        day += timedelta(days=1)
+
+def _seed_daily_facts():
+    first, last = _source_date_range()
+    if first:
+        rebuild_daily_facts(first, last)
+
+# In dependency order: the later tables read b2b_daily for their B2B columns,
+# so once a step runs every step after it runs again too
+SEED_STEPS = [
+    ('b2b_daily', _seed_b2b_daily),
+    ('average_rep_totals', _seed_average_totals),
+    ('daily_facts', _seed_daily_facts),
+    ('call_statistics_rollup', lambda: rebuild_stat_rollups('call_statistics')),
+    ('outlook_statistics_rollup', lambda: rebuild_stat_rollups('outlook_statistics')),
+]
+
+@anvil.server.background_task
+def seed_rollups_scheduled():
+    """Build each derived table not yet seeded from its source tables"""
+    reseed = False
+    for name, rebuild in SEED_STEPS:
+        if is_seeded(name) and not reseed:
+            continue
+        reseed = True
+        try:
+            print(f"Seeding {name}")
+            rebuild()
+            mark_seeded(name)
+        except Exception as e:
+            # Later steps depend on earlier ones, so stop and retry next run
+            print(f"Error seeding {name}: {e}")
+            return False
+    return True